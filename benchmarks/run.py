@@ -0,0 +1,234 @@
+"""
+Offline end-to-end benchmark: runs publishing cycles with the real processors against
+local Slack and GitHub stand-ins (fakes.slack_web, fakes.github_rest or fakes.github_graphql):
+
+    python -m benchmarks.run --messages 500 --thread_ratio 0.3 --latency_ms 50 --save baseline.json
+    python -m benchmarks.run --messages 500 --thread_ratio 0.3 --latency_ms 50 --compare baseline.json
+    python -m benchmarks.run --cycles 5 -- --cache_backend files --review_workers 4
+    python -m benchmarks.run --cycles 5 -- --engine asyncio
+
+Arguments after `--` are passed to the application (see `python main.py --help`), sharding,
+adaptive polling, webhooks and Slack events are not run by the benchmark.
+"""
+from clients import ClientRegistry, ReactionIndex, ThreadCache, ScanState, metrics
+from utils import get_arguments, RequestCoalescer
+from fakes import dataset, slack_web, github_rest, github_graphql
+import main
+
+from threading import Thread
+import multiprocessing
+import argparse
+import resource
+import tempfile
+import logging
+import shutil
+import queue
+import json
+import time
+import sys
+import os
+
+
+# results compared against a baseline, all of them are lower is better
+compared_results = ["warm_cycle_seconds", "first_cycle_seconds", "github_calls_per_pull_request",
+                    "slack_calls_per_cycle", "peak_rss_mb", "cache_bytes_written"]
+
+# application options the benchmark doesn't set up, with their values when not used
+unsupported_options = {"shard_by": "none", "github_max_poll_interval_minutes": 0,
+                       "github_webhook_port": 0, "slack_events_port": 0}
+
+
+def serve_fakes(scenario: dict, ports: multiprocessing.Queue, github_backend: str = "rest"):
+    """ Runs both stand-ins in a separate process, so they don't count towards the measured RSS """
+    logging.basicConfig(level=logging.WARNING)
+    pull_requests = dataset.generate_pull_requests(
+        scenario["pull_requests"], scenario["repositories"], scenario["approved_ratio"],
+        scenario["merged_ratio"], scenario["review_pages"], scenario["seed"])
+    channels = dataset.generate_channels(
+        scenario["channels"], scenario["messages"], scenario["time_window_minutes"],
+        scenario["pull_requests"], scenario["repositories"], scenario["thread_ratio"],
+        scenario["replies"], scenario["links_per_message"], scenario["seed"])
+    referenced = dataset.referenced_pull_requests(channels)
+
+    latency = scenario["latency_ms"] / 1000
+    if github_backend == "graphql":
+        github = github_graphql.serve(0, {key: {
+            "merged": state["merged"], "reviews": ["APPROVED" if state["approved"] else "COMMENTED"]
+        } for key, state in pull_requests.items()}, latency)
+    else:
+        github = github_rest.serve(0, pull_requests, latency, scenario["not_modified_rate"],
+                                   scenario["github_rate_limit_every"])
+    servers = [slack_web.serve(0, channels, latency, scenario["slack_rate_limit_every"]), github]
+    for server in servers[1:]:
+        Thread(target=server.serve_forever, daemon=True).start()
+    ports.put((servers[0].server_port, servers[1].server_port, len(referenced)))
+    servers[0].serve_forever()
+
+
+def counter_totals():
+    totals = {"github": 0, "slack": 0, "not_modified": 0}
+    with metrics.api_requests.lock:
+        requests = dict(metrics.api_requests.children)
+    for (client, endpoint, status), count in requests.items():
+        totals[client] += count
+        if status == "304":
+            totals["not_modified"] += count
+    totals["cache_bytes_written"] = sum(metrics.cache_bytes_written.children.values())
+    return totals
+
+
+def get_config(scenario: dict, app_args: list, slack_port: int, github_port: int,
+               cache_folder_path: str):
+    channels = [f"CBENCH{index:04d}" for index in range(scenario["channels"])]
+    return get_arguments([
+        "--slack_api_token", "xoxb-benchmark",
+        "--slack_api_url", f"http://127.0.0.1:{slack_port}/api/",
+        "--slack_channels", *channels,
+        "--slack_time_window_minutes", str(scenario["time_window_minutes"]),
+        "--github_api_token", "benchmark",
+        "--github_api_host", f"http://127.0.0.1:{github_port}",
+        "--cache_folder_path", cache_folder_path,
+        "--sleep_period_minutes", "1",
+        # the stand-ins don't enforce Slack's per method limits, 429s are injected instead
+        "--slack_requests_per_minute", "0",
+        *app_args
+    ])
+
+
+def run(scenario: dict, app_args: list):
+    # parsed before the stand-ins are up, as they depend on the selected backend
+    config = get_config(scenario, app_args, 0, 0, tempfile.gettempdir())
+    for name, unused in unsupported_options.items():
+        if getattr(config, name) != unused:
+            sys.exit(f"--{name} is not supported by the benchmark")
+    # the asyncio engine only uses the rest api
+    github_backend = config.github_backend if config.engine == "threads" else "rest"
+
+    context = multiprocessing.get_context("spawn")
+    ports = context.Queue()
+    fakes = context.Process(target=serve_fakes, args=(scenario, ports, github_backend), daemon=True)
+    fakes.start()
+    slack_port, github_port, referenced = ports.get(timeout=120)
+
+    cache_folder_path = tempfile.mkdtemp(prefix="pr-vigilante-bench-")
+    config = get_config(scenario, app_args, slack_port, github_port, cache_folder_path)
+
+    registry = ClientRegistry(config)
+    reaction_index = ReactionIndex()
+    thread_caches = {channel_id: ThreadCache() for channel_id in config.slack_channels}
+    if config.engine == "asyncio":
+        # imported here, so the threaded engine doesn't require aiohttp
+        from processors.async_engine import AsyncEngine
+        publish = AsyncEngine(config, registry.cache_client, reaction_index, thread_caches).publish
+    else:
+        coalescer = RequestCoalescer()
+        reviews_queue, details_queue = queue.Queue(), queue.Queue()
+        main.start_processors(config, reviews_queue, details_queue, registry, coalescer, reaction_index)
+        scan_states = None
+        if config.slack_incremental_scan:
+            scan_states = {channel_id: ScanState(
+                file_path=os.path.join(cache_folder_path, f"slack_scan_state_{channel_id}.json"),
+                full_scan_cycles=config.slack_full_scan_cycles
+            ) for channel_id in config.slack_channels}
+
+        def publish():
+            main.publish_to_queues(config, reviews_queue, details_queue, registry, coalescer,
+                                   reaction_index, thread_caches, scan_states)
+
+    cycles = []
+    try:
+        for cycle in range(scenario["cycles"]):
+            before = counter_totals()
+            started = time.monotonic()
+            publish()
+            seconds = time.monotonic() - started
+            after = counter_totals()
+            cycles.append({"seconds": round(seconds, 3),
+                           **{name: after[name] - before[name] for name in after}})
+            logging.warning(f"cycle {cycle + 1}: {cycles[-1]}")
+    finally:
+        registry.close()
+        fakes.terminate()
+        shutil.rmtree(cache_folder_path, ignore_errors=True)
+
+    warm = cycles[1:] or cycles
+    github_calls = sum(cycle["github"] for cycle in cycles)
+    return {
+        "scenario": scenario,
+        "app_args": app_args,
+        "cycles": cycles,
+        "results": {
+            "first_cycle_seconds": cycles[0]["seconds"],
+            "warm_cycle_seconds": round(sum(cycle["seconds"] for cycle in warm) / len(warm), 3),
+            "github_calls_per_pull_request": round(github_calls / max(referenced, 1) / len(cycles), 3),
+            "not_modified_ratio": round(sum(cycle["not_modified"] for cycle in cycles) / max(github_calls, 1), 3),
+            "slack_calls_per_cycle": round(sum(cycle["slack"] for cycle in cycles) / len(cycles), 1),
+            # ru_maxrss is reported in kilobytes on linux
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "cache_bytes_written": sum(cycle["cache_bytes_written"] for cycle in cycles),
+            "pull_requests_referenced": referenced
+        }
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float):
+    """ Prints results next to the baseline, returns the regressed ones """
+    if baseline["scenario"] != results["scenario"] or baseline["app_args"] != results["app_args"]:
+        print("warning: baseline was recorded with a different scenario")
+    regressions = []
+    print(f"{'result':<32}{'baseline':>14}{'current':>14}{'change':>10}")
+    for name in compared_results:
+        previous, current = baseline["results"][name], results["results"][name]
+        change = (current - previous) / previous * 100 if previous else 0.0
+        print(f"{name:<32}{previous:>14}{current:>14}{change:>+9.1f}%")
+        if change > tolerance:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+    app_args = argv[argv.index("--") + 1:] if "--" in argv else []
+    argv = argv[:argv.index("--")] if "--" in argv else argv
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--channels", type=int, default=1)
+    parser.add_argument("--messages", type=int, default=200, help="messages per channel")
+    parser.add_argument("--thread_ratio", type=float, default=0.2, help="share of messages with threads")
+    parser.add_argument("--replies", type=int, default=5, help="replies per thread (thread fan-out)")
+    parser.add_argument("--links_per_message", type=int, default=1)
+    parser.add_argument("--pull_requests", type=int, default=100, help="distinct pull requests")
+    parser.add_argument("--repositories", type=int, default=10)
+    parser.add_argument("--approved_ratio", type=float, default=0.5)
+    parser.add_argument("--merged_ratio", type=float, default=0.3)
+    parser.add_argument("--review_pages", type=int, default=1)
+    parser.add_argument("--time_window_minutes", type=int, default=60)
+    parser.add_argument("--latency_ms", type=float, default=20)
+    parser.add_argument("--not_modified_rate", type=float, default=0.8,
+                        help="share of conditional github requests answered with 304")
+    parser.add_argument("--github_rate_limit_every", type=int, default=0, help="inject a 429 every n requests")
+    parser.add_argument("--slack_rate_limit_every", type=int, default=0, help="inject a 429 every n requests")
+    parser.add_argument("--cycles", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", type=str, required=False, help="save results as a baseline")
+    parser.add_argument("--compare", type=str, required=False, help="compare results with a baseline")
+    parser.add_argument("--tolerance", type=float, default=10, help="allowed regression in percent")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING,
+                        format="%(asctime)s - %(levelname)s %(message)s")
+    options = vars(args)
+    scenario = {name: options[name] for name in options if name not in ("save", "compare", "tolerance")}
+    results = run(scenario, app_args)
+    print(json.dumps(results["results"], indent=2))
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"saved baseline to {args.save}")
+    if args.compare:
+        with open(args.compare, "r") as file:
+            regressed = compare(results, json.load(file), args.tolerance)
+        if regressed:
+            print(f"regressions above {args.tolerance}%: {', '.join(regressed)}")
+            sys.exit(1)
@@ -1,3 +1,7 @@
-from .github import GitHubClient
+from .github import GitHubClient, GitHubGraphQLClient
 from .slack import SlackClient
 from .cache import CacheClient, NoCachedData
+from .state import ScanState, ThreadCache, ReactionIndex, PollSchedule,\
+    PullRequestIndex
+from .registry import ClientRegistry
+from .leases import ShardCoordinator
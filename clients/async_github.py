@@ -0,0 +1,156 @@
+from .github import GitNotModified
+from .tracing import tracer
+from . import metrics
+from parsers import PullRequestReviewState
+import asyncio
+import logging
+import time
+import aiohttp
+
+
+class AsyncGitHubClient:
+    """ Asynchronous GitHub client class (used by the asyncio engine) """
+
+    reviews_per_page = 100
+
+    def __init__(self, api_token, api_host=None, max_retries=1, connections=100):
+        self.api_host = api_host if api_host else "https://api.github.com"
+        self.headers = {
+            "Accept": "application/vnd.github.v3+json",
+            "Authorization": f"token {api_token}"
+        }
+        self.max_retries = max_retries
+        self.connections = connections
+        self.session = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.connections)
+        self.session = aiohttp.ClientSession(headers=self.headers, connector=connector)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def api_call(self, api_route: str, headers: dict = None, query: dict = None):
+        api_url = f"{self.api_host}/{api_route}"
+        query = {key: value for key, value in (query or {}).items() if value is not None}
+        endpoint = metrics.github_endpoint(api_url)
+        attempt = 0
+        while True:
+            status = "error"
+            started = time.monotonic()
+            elapsed = None
+            try:
+                async with self.session.get(api_url, headers=headers, params=query) as response:
+                    # waiting for the quota to be renewed is not part of the latency
+                    status, elapsed = response.status, time.monotonic() - started
+                    remaining = response.headers.get("x-ratelimit-remaining")
+                    if response.status in (403, 429) and remaining == "0":
+                        logging.warning("api rate limit hit")
+                        reset_time = float(response.headers.get("x-ratelimit-reset", time.time()))
+                        await asyncio.sleep(max(reset_time - time.time(), 0))
+                        continue
+                    response.raise_for_status()
+                    body = None if response.status == 304 else await response.json()
+                    return response, body
+            except aiohttp.ClientConnectionError as err:
+                attempt += 1
+                if attempt > self.max_retries:
+                    logging.warning(f"Github API client error: {err}")
+                    raise
+            finally:
+                if elapsed is None:
+                    elapsed = time.monotonic() - started
+                metrics.api_request_duration.observe(elapsed, "github", endpoint)
+                metrics.api_requests.inc("github", endpoint, str(status))
+                tracer.record("github.api", elapsed)
+
+    async def get_pull_request(self, repo_owner, repo_name, number,
+                               entity_tag=None, last_modified=None):
+        api_route = f"repos/{repo_owner}/{repo_name}/pulls/{number}"
+        headers = {}
+
+        if entity_tag is not None:
+            headers["If-None-Match"] = entity_tag
+        if last_modified is not None:
+            headers["If-Modified-Since"] = last_modified
+
+        response, details = await self.api_call(api_route, headers=headers)
+
+        if (entity_tag or last_modified) and response.status == 304:
+            raise GitNotModified("requested object was not modified")
+
+        # aiohttp keeps header names as sent (e.g. Etag), cached records look up the canonical ones
+        return {
+            "headers": {"ETag": response.headers.get("ETag"),
+                        "Last-Modified": response.headers.get("Last-Modified")},
+            "details": details
+        }
+
+    async def get_pull_request_review_page(self, repo_owner, repo_name, number, page,
+                                           cached_page: dict = None):
+        api_route = f"repos/{repo_owner}/{repo_name}/pulls/{number}/reviews"
+        api_query = {"page": page, "per_page": self.reviews_per_page}
+        headers = {}
+
+        if cached_page and cached_page.get("etag"):
+            headers["If-None-Match"] = cached_page["etag"]
+        if cached_page and cached_page.get("last_modified"):
+            headers["If-Modified-Since"] = cached_page["last_modified"]
+
+        response, reviews = await self.api_call(api_route, headers=headers, query=api_query)
+
+        if cached_page and response.status == 304:
+            return cached_page, False, None
+
+        page_summary = PullRequestReviewState.summarize_page(reviews)
+        page_summary.update({
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified")
+        })
+        last_page = None
+        if "last" in response.links:
+            last_page = int(response.links["last"]["url"].query.get("page", page))
+        return page_summary, True, last_page
+
+    async def get_pull_request_reviews(self, repo_owner, repo_name, number, pages: dict = None):
+        # same page walk as GitHubClient.iter_pull_request_review_pages, newest page first
+        pages = pages or {}
+        params = (repo_owner, repo_name, number)
+        fetched = {}
+
+        page = max((int(number) for number in pages), default=1)
+        while True:
+            page_summary, modified, last_page = await self.get_pull_request_review_page(
+                *params, page, pages.get(str(page)))
+            fetched[page] = page_summary, modified
+            if last_page and last_page > page:
+                page = last_page
+            elif not modified and page_summary["count"] >= self.reviews_per_page:
+                page += 1
+            else:
+                break
+
+        review_state = PullRequestReviewState()
+        fetched_pages = {}
+        any_modified = False
+        for page in range(page, 0, -1):
+            if page not in fetched:
+                fetched[page] = (await self.get_pull_request_review_page(
+                    *params, page, pages.get(str(page))))[:2]
+            page_summary, modified = fetched[page]
+            fetched_pages[str(page)] = page_summary
+            any_modified = any_modified or modified
+            review_state.fold_page(page_summary)
+            if review_state.decided:
+                break
+
+        if pages and not any_modified:
+            raise GitNotModified("requested object was not modified")
+
+        return {
+            "headers": {},
+            "reviews": [review_state.last_review] if review_state.last_review else [],
+            "reviewers": review_state.reviewers,
+            "pages": {**pages, **fetched_pages}
+        }
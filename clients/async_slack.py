@@ -0,0 +1,98 @@
+from slack_sdk.web.async_client import AsyncWebClient
+from slack_sdk.errors import SlackApiError
+from slack_sdk.http_retry.builtin_async_handlers import AsyncConnectionErrorRetryHandler,\
+    AsyncRateLimitErrorRetryHandler
+
+from utils import log_summary
+from . import metrics
+from .slack import set_conv_params
+from .tracing import tracer
+from functools import wraps
+import logging
+import time
+
+
+class AsyncSlackClient:
+    """ Asynchronous Slack session class (used by the asyncio engine) """
+
+    # endpoint names used by SlackClient, so both engines report comparable metrics
+    endpoints = {"reactions.add": "add_message_reaction",
+                 "conversations.history": "get_conversation_history",
+                 "conversations.replies": "get_conversation_replies"}
+
+    def __init__(self, api_token: str, max_retries=1, api_url: str = None):
+        self.client = AsyncWebClient(api_token, base_url=api_url) if api_url else AsyncWebClient(api_token)
+        self.client.retry_handlers.append(
+            AsyncConnectionErrorRetryHandler(max_retry_count=max_retries))
+        # 429 responses are retried after Retry-After by the SDK
+        self.client.retry_handlers.append(
+            AsyncRateLimitErrorRetryHandler(max_retry_count=max_retries))
+        self.measure_api_calls()
+
+    def measure_api_calls(self):
+        api_call = self.client.api_call
+
+        @wraps(api_call)
+        async def measured_api_call(api_method: str, **kwargs):
+            endpoint = self.endpoints.get(api_method, api_method)
+            status = "error"
+            started = time.monotonic()
+            try:
+                response = await api_call(api_method, **kwargs)
+                status = "ok"
+                return response
+            except SlackApiError as err:
+                status = str(err.response.status_code)
+                raise
+            finally:
+                elapsed = time.monotonic() - started
+                metrics.api_request_duration.observe(elapsed, "slack", endpoint)
+                metrics.api_requests.inc("slack", endpoint, status)
+                tracer.record(f"slack.{endpoint}", elapsed)
+
+        # AsyncWebClient methods (conversations_history, reactions_add, ...) all go through api_call
+        self.client.api_call = measured_api_call
+
+    async def add_message_reaction(self, channel: str, reaction: str, timestamp: str, dry_run: bool):
+        if dry_run:
+            logging.info(f"dry-run: adding reaction '{reaction}'"
+                         f" to message [{timestamp}]")
+            return True
+        try:
+            logging.info(f"adding reaction '{reaction}' to message [{timestamp}]")
+            await self.client.reactions_add(channel=channel, name=reaction, timestamp=timestamp)
+            return True
+        except SlackApiError as err:
+            if err.response["error"] == "already_reacted":
+                return True
+            logging.warning(f"error reacting to message [{timestamp}]: {err}")
+            return False
+
+    async def get_conversation_history(self, channel: str, minutes: int):
+        messages = []
+        history = await self.client.conversations_history(**set_conv_params(channel, minutes))
+        messages.extend(history["messages"])
+
+        while history.get("has_more"):
+            last_ts = history["messages"][-1]["ts"]
+            history = await self.client.conversations_history(
+                **set_conv_params(channel, minutes, last_ts))
+            messages.extend(history["messages"])
+        logging.info(f"fetched {len(messages)} messages")
+        return messages
+
+    async def get_conversation_replies(self, channel: str, minutes: int, ts: str):
+        replies = []
+        params = set_conv_params(channel, minutes)
+        history = await self.client.conversations_replies(ts=ts, **params)
+        replies.extend(history["messages"])
+
+        while history.get("has_more"):
+            last_ts = history["messages"][-1]["ts"]
+            params = set_conv_params(channel, minutes, last_ts)
+            history = await self.client.conversations_replies(ts=ts, **params)
+            replies.extend(history["messages"])
+        log_summary.count("thread_replies", len(replies) - 1)
+        if len(replies) > 1 and log_summary.sampled():
+            logging.info("fetched %d replies for message %s", len(replies), ts)
+        return replies
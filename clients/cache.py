@@ -1,4 +1,12 @@
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from utils import log_summary
+from .tracing import tracer
+from . import metrics
+from threading import Thread, Lock, Event, get_ident
 import logging
+import time
+import sqlite3
 import shutil
 import json
 import os
@@ -8,10 +16,245 @@ class NoCachedData(Exception):
     pass
 
 
-class CacheClient:
+class CacheBackend(ABC):
+    """ Cache storage interface, entries are addressed by cache path and file name """
+
     def __init__(self, local_dir_path: str):
         self.local_dir_path = local_dir_path
+
+    @abstractmethod
+    def save(self, file_data: dict, dir_path: str, file_name: str):
+        pass
+
+    @abstractmethod
+    def load(self, dir_path: str, file_name: str):
+        pass
+
+    @abstractmethod
+    def delete(self, dir_path: str):
+        pass
+
+    def delete_many(self, dir_paths: list):
+        for dir_path in dir_paths:
+            self.delete(dir_path)
+
+    @abstractmethod
+    def entries(self):
+        """ Returns (dir path, last update timestamp, size in bytes) of all entries """
+
+
+class FileCacheBackend(CacheBackend):
+    """ Directory-per-PR JSON files cache storage """
+
+    def save(self, file_data: dict, dir_path: str, file_name: str, attempts: int = 3):
+        dir_path = os.path.join(self.local_dir_path, dir_path)
+        file_path = os.path.join(dir_path, file_name)
+
+        for attempt in range(attempts):
+            if not os.path.exists(dir_path):
+                os.makedirs(dir_path, exist_ok=True)
+            try:
+                if log_summary.sampled():
+                    logging.info("caching data to file %s, path %s", file_name, dir_path)
+                # written aside and renamed, so readers (other replicas too) never see partial files
+                tmp_file_path = f"{file_path}.{os.getpid()}.{get_ident()}.tmp"
+                with open(tmp_file_path, "w") as file:
+                    json.dump(file_data, file, ensure_ascii=False, separators=(",", ":"))
+                    metrics.cache_bytes_written.inc(amount=file.tell())
+                os.replace(tmp_file_path, file_path)
+                return
+            except FileNotFoundError:
+                # a shared parent directory was pruned by another worker meanwhile
+                if attempt == attempts - 1:
+                    raise
+
+    def load(self, dir_path: str, file_name: str):
+        dir_path = os.path.join(self.local_dir_path, dir_path)
+
+        if not os.path.exists(dir_path):
+            raise NoCachedData
+        else:
+            if log_summary.sampled():
+                logging.info("loading cached data from file %s, path %s", file_name, dir_path)
+            file_path = os.path.join(dir_path, file_name)
+            try:
+                with open(file_path, "r+") as file:
+                    file_data = json.load(file)
+                    return file_data
+            except FileNotFoundError:
+                # cleaned up by another worker (or replica) since the check above
+                raise NoCachedData
+
+    def clean_up_empty_dirs(self, dir_path: str):
+        # only walk up from the removed path instead of sweeping the whole cache
+        root_path = os.path.realpath(self.local_dir_path)
+        dir_path = os.path.realpath(os.path.dirname(dir_path))
+        while dir_path.startswith(root_path + os.sep):
+            try:
+                os.rmdir(dir_path)
+                logging.info(f"removed empty directory {dir_path}")
+            except FileNotFoundError:
+                logging.info(f"{dir_path} does not exist - "
+                             f"probably removed by another processor?")
+            except OSError:
+                # not empty (anymore), parents aren't empty either
+                return
+            dir_path = os.path.dirname(dir_path)
+
+    def delete(self, dir_path: str):
+        dir_path = os.path.join(self.local_dir_path, dir_path)
+        logging.info(f"cleaning up directory path {dir_path}")
+        shutil.rmtree(dir_path, onerror=FileNotFoundError)
+        self.clean_up_empty_dirs(dir_path)
+
+    def entries(self):
+        entries = []
+        for current_dir, sub_dirs, files in os.walk(self.local_dir_path):
+            if "data.json" not in files:
+                continue
+            stat = os.stat(os.path.join(current_dir, "data.json"))
+            dir_path = os.path.relpath(current_dir, self.local_dir_path).replace(os.sep, "/")
+            entries.append((dir_path, stat.st_mtime, stat.st_size))
+        return entries
+
+
+class SQLiteCacheBackend(CacheBackend):
+    """ Single-file SQLite cache storage keyed by pull request and kind """
+
+    def __init__(self, local_dir_path: str, file_name: str = "cache.db"):
+        super().__init__(local_dir_path)
+        self.db_path = os.path.join(local_dir_path, file_name)
+        self.lock = Lock()  # the connection is shared by all worker threads
+        self.connection = sqlite3.connect(self.db_path, timeout=30,
+                                          check_same_thread=False,
+                                          isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS entries ("
+                                "pull_request TEXT NOT NULL, "
+                                "kind TEXT NOT NULL, "
+                                "data TEXT NOT NULL, "
+                                "updated_at REAL NOT NULL DEFAULT 0, "
+                                "PRIMARY KEY (pull_request, kind))")
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(entries)")]
+        if "updated_at" not in columns:
+            self.connection.execute("ALTER TABLE entries ADD COLUMN "
+                                    "updated_at REAL NOT NULL DEFAULT 0")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta ("
+                                "name TEXT PRIMARY KEY, value TEXT)")
+        self.migrate_from_files()
+
+    @staticmethod
+    def serialize(file_data: dict):
+        return json.dumps(file_data, ensure_ascii=False, separators=(",", ":"))
+
+    @staticmethod
+    def entry_key(dir_path: str, file_name: str):
+        # "repos/<owner>/<repo>/<n>/details" -> ("repos/<owner>/<repo>/<n>", "details")
+        pull_request, _, kind = dir_path.strip("/").rpartition("/")
+        if file_name != "data.json":
+            kind = f"{kind}/{file_name}"
+        return pull_request, kind
+
+    def save(self, file_data: dict, dir_path: str, file_name: str):
+        if log_summary.sampled():
+            logging.info("caching data to %s, path %s", self.db_path, dir_path)
+        data = self.serialize(file_data)
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO entries (pull_request, kind, data, updated_at) "
+                                    "VALUES (?, ?, ?, ?)",
+                                    (*self.entry_key(dir_path, file_name), data, time.time()))
+        metrics.cache_bytes_written.inc(amount=len(data.encode()))
+
+    def load(self, dir_path: str, file_name: str):
+        with self.lock:
+            row = self.connection.execute("SELECT data FROM entries "
+                                          "WHERE pull_request = ? AND kind = ?",
+                                          self.entry_key(dir_path, file_name)).fetchone()
+        if row is None:
+            raise NoCachedData
+        if log_summary.sampled():
+            logging.info("loading cached data from %s, path %s", self.db_path, dir_path)
+        return json.loads(row[0])
+
+    def delete(self, dir_path: str):
+        logging.info(f"cleaning up cached path {dir_path}")
+        self.delete_many([dir_path])
+
+    def delete_many(self, dir_paths: list):
+        with self.lock:
+            self.connection.executemany("DELETE FROM entries WHERE pull_request = ? AND kind = ?",
+                                        [self.entry_key(dir_path, "data.json") for dir_path in dir_paths])
+
+    def entries(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT pull_request, kind, updated_at, length(data) "
+                                           "FROM entries").fetchall()
+        return [(f"{pull_request}/{kind}", updated_at, size)
+                for pull_request, kind, updated_at, size in rows]
+
+    def migrate_from_files(self):
+        repos_path = os.path.join(self.local_dir_path, "repos")
+        migrated = self.connection.execute("SELECT value FROM meta "
+                                           "WHERE name = 'files_migrated'").fetchone()
+        if migrated or not os.path.exists(repos_path):
+            return
+
+        logging.info(f"migrating cached files from {repos_path} to {self.db_path}")
+        entries = 0
+        self.connection.execute("BEGIN")
+        for current_dir, sub_dirs, files in os.walk(repos_path):
+            dir_path = os.path.relpath(current_dir, self.local_dir_path).replace(os.sep, "/")
+            for file_name in files:
+                try:
+                    with open(os.path.join(current_dir, file_name), "r") as file:
+                        file_data = json.load(file)
+                except (OSError, ValueError) as err:
+                    logging.warning(f"skipping cached file {file_name} under {dir_path}: {err}")
+                    continue
+                self.connection.execute("INSERT OR IGNORE INTO entries (pull_request, kind, data, updated_at) "
+                                        "VALUES (?, ?, ?, ?)",
+                                        (*self.entry_key(dir_path, file_name),
+                                         self.serialize(file_data), time.time()))
+                entries += 1
+        self.connection.execute("INSERT OR REPLACE INTO meta (name, value) "
+                                "VALUES ('files_migrated', '1')")
+        self.connection.execute("COMMIT")
+
+        # kept aside instead of deleted, e.g. for a rollback to the files backend
+        migrated_path = f"{repos_path}.migrated"
+        if not os.path.exists(migrated_path):
+            os.rename(repos_path, migrated_path)
+        logging.info(f"migrated {entries} cached files, the old files were moved to {migrated_path} "
+                     f"and can be removed")
+
+
+cache_backends = {
+    "files": FileCacheBackend,
+    "sqlite": SQLiteCacheBackend
+}
+
+
+class CacheClient:
+    def __init__(self, local_dir_path: str, memory_size: int = 0, flush_interval: int = 0,
+                 backend: str = "files", lock_stripes: int = 64):
+        self.local_dir_path = local_dir_path
         self.create_local_cache_dir()
+        self.backend = cache_backends[backend](local_dir_path)
+
+        # in-memory LRU tier: (dir path, file name) -> data
+        self.memory_size = memory_size
+        self.memory = OrderedDict()
+        self.dirty = set()
+        self.lock = Lock()
+
+        # per pull request locks, so parallel workers never race on the same entry
+        self.stripes = [Lock() for _ in range(lock_stripes)]
+
+        # dirty entries are written behind on a timer (or right away if disabled)
+        self.flush_interval = flush_interval
+        self.stopped = Event()
+        if self.memory_size and self.flush_interval:
+            Thread(target=self.flush_periodically, name="CacheFlusher", daemon=True).start()
 
     def create_local_cache_dir(self):
         if not os.path.exists(self.local_dir_path):
@@ -23,53 +266,142 @@ class CacheClient:
                          f" {self.local_dir_path}")
             return
 
+    def path_lock(self, dir_path: str):
+        # "repos/<owner>/<repo>/<n>/details" and ".../reviews" share the pull request stripe
+        pull_request = dir_path.strip("/").rpartition("/")[0]
+        return self.stripes[hash(pull_request) % len(self.stripes)]
+
     def save_data_to_file(self, file_data: dict,
                           dir_path: str, file_name: str = None):
         file_name = file_name if file_name else "data.json"
-        dir_path = os.path.join(self.local_dir_path, dir_path)
-        file_path = os.path.join(dir_path, file_name)
-
-        if not os.path.exists(dir_path):
-            logging.info(f"creating file {file_name} under path {dir_path}")
-            os.makedirs(dir_path)
-
-        logging.info(f"caching data to file {file_name}, path {dir_path}")
-        with open(file_path, "w") as file:
-            json.dump(file_data, file, ensure_ascii=False, indent=2)
+        if self.memory_size:
+            key = (dir_path, file_name)
+            with self.lock:
+                if key in self.memory and self.memory[key] == file_data:
+                    logging.debug(f"cached data under path {dir_path} is unchanged")
+                    self.memory.move_to_end(key)
+                    return
+                self.remember(key, file_data)
+                if self.flush_interval:
+                    self.dirty.add(key)
+                    return
+        with self.path_lock(dir_path), tracer.span("cache.write"):
+            self.backend.save(file_data, dir_path, file_name)
 
     def load_data_from_file(self, dir_path: str, file_name: str = None):
         file_name = file_name if file_name else "data.json"
-        dir_path = os.path.join(self.local_dir_path, dir_path)
+        key = (dir_path, file_name)
+        if self.memory_size:
+            with self.lock:
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    metrics.cache_lookups.inc("memory_hit")
+                    return self.memory[key]
+        with self.path_lock(dir_path):
+            try:
+                with tracer.span("cache.read"):
+                    file_data = self.backend.load(dir_path, file_name)
+            except NoCachedData:
+                metrics.cache_lookups.inc("miss")
+                raise
+            metrics.cache_lookups.inc("hit")
+            if self.memory_size:
+                with self.lock:
+                    self.remember(key, file_data)
+        return file_data
 
-        if not os.path.exists(dir_path):
-            raise NoCachedData
-        else:
-            logging.info(f"loading cached data from file {file_name}, path {dir_path}")
-            file_path = os.path.join(dir_path, file_name)
-            with open(file_path, "r+") as file:
-                file_data = json.load(file)
-                return file_data
-
-    def clean_up_empty_dirs(self):
-        directories = [os.path.join(current_dir, _dir)
-                       for current_dir, sub_dirs, files in os.walk(self.local_dir_path, topdown=False)
-                       for _dir in sub_dirs]
-        for dir_path in directories:
+    def remember(self, key: tuple, file_data: dict):
+        # caller holds the lock
+        self.memory[key] = file_data
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_size:
+            evicted_key, evicted_data = self.memory.popitem(last=False)
+            metrics.cache_evictions.inc("memory")
+            if evicted_key in self.dirty:
+                self.dirty.discard(evicted_key)
+                self.backend.save(evicted_data, *evicted_key)
+
+    def flush(self):
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+        if dirty:
+            logging.info(f"flushing {len(dirty)} cached entries")
+        for key in dirty:
+            with self.path_lock(key[0]):
+                with self.lock:
+                    # skip entries cleaned up since the snapshot
+                    file_data = self.memory.get(key)
+                if file_data is not None:
+                    with tracer.span("cache.write"):
+                        self.backend.save(file_data, *key)
+
+    def flush_periodically(self):
+        while not self.stopped.wait(self.flush_interval):
             try:
-                if not os.listdir(dir_path):
-                    logging.info(f"removing empty directory {dir_path}")
-                    os.rmdir(os.path.realpath(os.path.join(dir_path)))
-            except FileNotFoundError:
-                logging.info(f"{dir_path} does not exist - "
-                             f"probably removed by another processor?")
+                self.flush()
+            except (OSError, sqlite3.Error) as err:
+                logging.warning(f"error flushing cached data: {err}")
+
+    def close(self):
+        self.stopped.set()
+        self.flush()
+
+    def evict(self, referenced: set, ttl_seconds: float = 0, max_size_bytes: int = 0):
+        """ Evicts entries of pull requests not referenced by any message in the time window
+        (unless referenced is None), entries not updated for ttl_seconds and the oldest
+        entries above max_size_bytes """
+        stats = {"unreferenced": 0, "expired": 0, "over_size_cap": 0}
+        with self.lock:
+            # make sure the store holds the latest data before deciding
+            for key in self.dirty:
+                self.backend.save(self.memory[key], *key)
+            self.dirty = set()
+
+            time_now = time.time()
+            evicted, kept = [], []
+            for dir_path, updated_at, size in self.backend.entries():
+                pull_request = dir_path.rpartition("/")[0]
+                if referenced is not None and pull_request not in referenced:
+                    stats["unreferenced"] += 1
+                    evicted.append(dir_path)
+                elif ttl_seconds and time_now - updated_at > ttl_seconds:
+                    stats["expired"] += 1
+                    evicted.append(dir_path)
+                else:
+                    kept.append((updated_at, size, dir_path))
+
+            cache_size = sum(size for updated_at, size, dir_path in kept)
+            if max_size_bytes:
+                for updated_at, size, dir_path in sorted(kept):
+                    if cache_size <= max_size_bytes:
+                        break
+                    stats["over_size_cap"] += 1
+                    evicted.append(dir_path)
+                    cache_size -= size
+
+            if evicted:
+                self.backend.delete_many(evicted)
+                evicted = set(evicted)
+                for key in [key for key in self.memory if key[0] in evicted]:
+                    self.memory.pop(key)
+
+        stats["entries"] = len(kept) - stats["over_size_cap"]
+        stats["size_bytes"] = cache_size
+        for reason in ("unreferenced", "expired", "over_size_cap"):
+            metrics.cache_evictions.inc(reason, amount=stats[reason])
+        metrics.cache_size_bytes.set(cache_size)
+        return stats
 
     def clean_up_cached_dir(self, dir_path: str):
         if not dir_path:
             logging.warning("no directory path was provided")
             return
         else:
-            dir_path = os.path.join(self.local_dir_path, dir_path)
-            logging.info(f"cleaning up directory path {dir_path}")
-            shutil.rmtree(dir_path, onerror=FileNotFoundError)
-            self.clean_up_empty_dirs()
+            with self.path_lock(dir_path):
+                with self.lock:
+                    # forget entries kept in memory for this path
+                    for key in [key for key in self.memory if key[0] == dir_path]:
+                        self.memory.pop(key)
+                        self.dirty.discard(key)
+                self.backend.delete(dir_path)
             return
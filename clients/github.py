@@ -1,35 +1,30 @@
+from contextlib import contextmanager
 from functools import wraps
+from threading import Lock, local
+from urllib.parse import urlparse, parse_qs
+from parsers import PullRequestReviewState
 from utils import sleep_until
+from .tracing import tracer
+from . import metrics
 import logging
 import requests
+import time
 from requests.adapters import HTTPAdapter
+from requests.exceptions import HTTPError, RequestException
 
 
 def api_rate_control(func):
     @wraps(func)
-    def wrapper(*args, **kwargs):
+    def wrapper(self, *args, **kwargs):
         while True:
-            result = func(*args, **kwargs)
-            limit = result.headers.get(
-                "x-ratelimit-limit")
-            remaining = result.headers.get(
-                "x-ratelimit-remaining")
-            reset_time = result.headers.get(
-                "x-ratelimit-reset")
-            used = result.headers.get(
-                "x-ratelimit-used"
-            )
-            if remaining == 0:
-                logging.warning("api rate limit hit")
-                time_wait = float(reset_time)
-                sleep_until(time_wait)
-                continue
-            else:
-                logging.info(f"github api quota used:"
-                             f" {used} / limit {limit}")
-                logging.info(f"github api quota remaining:"
-                             f" {remaining}")
-                return result
+            # waits for (or defers) the call depending on the shared quota
+            self.budget.acquire()
+            try:
+                return func(self, *args, **kwargs)
+            except HTTPError as err:
+                if not RateLimitBudget.is_exhausted(err.response):
+                    raise
+                logging.warning("github api rate limit hit")
 
     return wrapper
 
@@ -39,38 +34,157 @@ class GitNotModified(Exception):
     pass
 
 
+class GitRateLimitDeferred(Exception):
+    """ Raised when a low priority call is deferred to save the API quota """
+    pass
+
+
+class RateLimitBudget:
+    """ Thread-safe GitHub API quota shared by all threads of the process """
+
+    def __init__(self, reserve_percent: int = 10, resource: str = "core"):
+        self.reserve_percent = reserve_percent
+        self.resource = resource  # GitHub keeps separate quotas, e.g. core (REST) and graphql
+        self.limit = None
+        self.remaining = None
+        self.used = None
+        self.reset_time = None
+        self.next_call = 0.0
+        self.deferred = 0
+        self.lock = Lock()
+        self.local = local()  # priority of the calls made by the current thread
+
+    @staticmethod
+    def is_exhausted(response):
+        return response is not None and response.status_code in (403, 429) \
+            and response.headers.get("x-ratelimit-remaining") == "0"
+
+    @contextmanager
+    def prioritize(self, high_priority: bool):
+        previous = getattr(self.local, "high_priority", True)
+        self.local.high_priority = high_priority
+        try:
+            yield
+        finally:
+            self.local.high_priority = previous
+
+    @property
+    def reserve(self):
+        return (self.limit or 0) * self.reserve_percent // 100
+
+    def update(self, headers):
+        remaining = headers.get("x-ratelimit-remaining")
+        reset_time = headers.get("x-ratelimit-reset")
+        if remaining is None or reset_time is None:
+            return
+        if headers.get("x-ratelimit-resource", self.resource) != self.resource:
+            return
+        with self.lock:
+            self.limit = int(headers.get("x-ratelimit-limit", remaining))
+            used = int(headers.get("x-ratelimit-used", self.limit - int(remaining)))
+            # the quota reported by GitHub replaces the local count (304s aren't charged),
+            # unless it comes with a response of an older call arriving out of order
+            if self.reset_time != float(reset_time) or self.used is None or used >= self.used:
+                self.remaining = int(remaining)
+                self.used = used
+            self.reset_time = float(reset_time)
+            metrics.github_rate_limit_remaining.set(self.remaining)
+            metrics.github_rate_limit_limit.set(self.limit)
+        logging.debug("github api quota remaining: %s / limit %s", remaining, self.limit)
+
+    def acquire(self):
+        high_priority = getattr(self.local, "high_priority", True)
+        with self.lock:
+            time_now = time.time()
+            if self.remaining is None or time_now >= self.reset_time:
+                # quota is unknown or was renewed already
+                self.remaining = None
+                return
+            if self.remaining > self.reserve:
+                self.remaining -= 1
+                return
+            if not high_priority:
+                self.deferred += 1
+                metrics.github_deferred_lookups.inc()
+                raise GitRateLimitDeferred(f"github api quota is low ({self.remaining} calls left), "
+                                           f"deferring low priority lookup")
+            if self.remaining <= 0:
+                call_time = self.reset_time
+            else:
+                # spread the calls left evenly until the quota is renewed
+                interval = (self.reset_time - time_now) / self.remaining
+                call_time = max(time_now, self.next_call)
+                self.next_call = call_time + interval
+                self.remaining -= 1
+        if call_time > time_now:
+            logging.info(f"github api quota is low, pacing next call by {call_time - time_now:.1f}s")
+            sleep_until(call_time)
+
+    def summary(self):
+        with self.lock:
+            deferred = self.deferred
+            self.deferred = 0
+            return {"remaining": self.remaining, "limit": self.limit,
+                    "reset_time": self.reset_time, "deferred": deferred}
+
+
 class GitHubClient:
     """ GitHub client class """
 
-    def __init__(self, api_token, api_host=None, max_retries=1):
+    reviews_per_page = 100
+
+    def __init__(self, api_token, api_host=None, max_retries=1, pool_size=10,
+                 budget: RateLimitBudget = None):
         self.api_host = api_host if api_host else "https://api.github.com"
         self.headers = {
             "Accept": "application/vnd.github.v3+json",
             "Authorization": f"token {api_token}"
         }
+        # keep-alive connections are pooled and reused by all threads sharing the client
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                                   max_retries=max_retries)
         self.client = requests.Session()
-        self.client.mount(self.api_host, HTTPAdapter(max_retries=max_retries))
+        self.client.mount(self.api_host, self.adapter)
+        self.budget = budget if budget else RateLimitBudget()
+
+    def connection_stats(self):
+        stats = {"requests": 0, "connections": 0}
+        pools = self.adapter.poolmanager.pools
+        for pool_key in pools.keys():
+            pool = pools[pool_key]
+            stats["requests"] += pool.num_requests
+            stats["connections"] += pool.num_connections
+        return stats
 
     @api_rate_control
     def api_call(self, api_url=None, api_route=None, verb=None,
                  headers: dict = None, query: dict = None, data: dict = None):
-        headers = {**self.headers, **(headers or {})}
+        request_headers = {**self.headers, **(headers or {})}
         if verb is None:
             verb = "POST" if data else "GET"
         if api_url is None:
             api_url = f"{self.api_host}/{api_route}"
+        endpoint = metrics.github_endpoint(api_url)
+        status = "error"
+        started = time.monotonic()
         try:
-            logging.debug(f"calling api endpoint {api_url} "
-                          f"with headers {headers} "
-                          f"and parameters {query}")
+            # only the per call headers, the client's ones hold the auth token
+            logging.debug("calling api endpoint %s with headers %s and parameters %s", api_url, headers, query)
             response = self.client.request(method=verb, url=api_url,
-                                           headers=headers,
+                                           headers=request_headers,
                                            params=query, json=data)
+            status = response.status_code
+            self.budget.update(response.headers)
             response.raise_for_status()
             return response
         except requests.exceptions.RequestException as err:
             logging.warning(f"Github API client error: {err}")
             raise
+        finally:
+            elapsed = time.monotonic() - started
+            metrics.api_request_duration.observe(elapsed, "github", endpoint)
+            metrics.api_requests.inc("github", endpoint, str(status))
+            tracer.record("github.api", elapsed)
 
     def get_pull_request(self, repo_owner, repo_name, number,
                          entity_tag=None, last_modified=None):
@@ -94,37 +208,195 @@ class GitHubClient:
             "details": response.json()
         }
 
-    def get_pull_request_reviews(self, repo_owner, repo_name, number, page=None,
-                                 entity_tag=None, last_modified=None):
+    def get_pull_request_review_page(self, repo_owner, repo_name, number, page,
+                                     cached_page: dict = None):
         api_route = f"repos/{repo_owner}/{repo_name}/pulls/{number}/reviews"
-        api_query = {"page": page, "per_page": 100}
+        api_query = {"page": page, "per_page": self.reviews_per_page}
         headers = {}
 
-        if entity_tag is not None:
-            headers["If-None-Match"] = entity_tag
-        if last_modified is not None:
-            headers["If-Modified-Since"] = last_modified
+        if cached_page and cached_page.get("etag"):
+            headers["If-None-Match"] = cached_page["etag"]
+        if cached_page and cached_page.get("last_modified"):
+            headers["If-Modified-Since"] = cached_page["last_modified"]
 
         response = self.api_call(api_route=api_route,
                                  verb="GET",
                                  query=api_query,
                                  headers=headers)
 
-        if (entity_tag or last_modified) and response.status_code == 304:
+        if cached_page and response.status_code == 304:
+            return cached_page, False, None
+
+        page_summary = PullRequestReviewState.summarize_page(response.json())
+        page_summary.update({
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified")
+        })
+        last_page = None
+        if "last" in response.links.keys():
+            last_url = urlparse(response.links["last"]["url"])
+            last_page = int(parse_qs(last_url.query).get("page", [page])[0])
+        return page_summary, True, last_page
+
+    def iter_pull_request_review_pages(self, repo_owner, repo_name, number, pages: dict = None):
+        """ Yields (page, page summary, modified) starting from the newest page """
+        pages = pages or {}
+        fetched = {}
+
+        # find the newest page, starting from the newest one seen before
+        page = max((int(number) for number in pages), default=1)
+        while True:
+            page_summary, modified, last_page = self.get_pull_request_review_page(
+                repo_owner, repo_name, number, page, pages.get(str(page)))
+            fetched[page] = page_summary, modified
+            if last_page and last_page > page:
+                page = last_page
+            elif not modified and page_summary["count"] >= self.reviews_per_page:
+                # an unchanged full page may have been followed by new reviews
+                page += 1
+            else:
+                break
+
+        for page in range(page, 0, -1):
+            if page not in fetched:
+                fetched[page] = self.get_pull_request_review_page(
+                    repo_owner, repo_name, number, page, pages.get(str(page)))[:2]
+            page_summary, modified = fetched[page]
+            yield page, page_summary, modified
+
+    def get_pull_request_reviews(self, repo_owner, repo_name, number, pages: dict = None):
+        review_state = PullRequestReviewState()
+        fetched_pages = {}
+        modified = False
+
+        for page, page_summary, page_modified in self.iter_pull_request_review_pages(
+                repo_owner, repo_name, number, pages):
+            fetched_pages[str(page)] = page_summary
+            modified = modified or page_modified
+            review_state.fold_page(page_summary)
+            # older pages can't change the decision anymore
+            if review_state.decided:
+                break
+
+        if pages and not modified:
             raise GitNotModified("requested object was not modified")
 
-        result = {
-            "headers": dict(response.headers),
-            "reviews": response.json()
+        return {
+            "headers": {},
+            "reviews": [review_state.last_review] if review_state.last_review else [],
+            "reviewers": review_state.reviewers,
+            "pages": {**(pages or {}), **fetched_pages}
         }
 
-        if page is None and "next" in response.links.keys():
-            while "next" in response.links.keys():
-                _response = self.api_call(api_url=response.links["next"]["url"],
-                                          verb="GET",
-                                          query=api_query,
-                                          headers=headers)
-                result["headers"] = dict(_response.headers)
-                result["reviews"] = _response.json()
 
-        return result
+class GitGraphQLError(HTTPError):
+    """ Raised when a pull request could not be resolved by the GraphQL API """
+    pass
+
+
+class GitHubGraphQLClient(GitHubClient):
+    """ GitHub GraphQL client class, batching pull request state lookups """
+
+    pull_request_fields = """
+        url
+        merged
+        state
+        reviews(last: 1) { nodes { state url } }
+    """
+
+    # errors of single aliases stored as unresolved pull requests, other ones are retried
+    unresolved_error_types = ("NOT_FOUND", "FORBIDDEN")
+
+    def __init__(self, api_token, api_host=None, max_retries=1, pool_size=10,
+                 budget: RateLimitBudget = None, batch_size=50):
+        super().__init__(api_token, api_host, max_retries, pool_size,
+                         budget if budget else RateLimitBudget(resource="graphql"))
+        self.batch_size = batch_size
+        self.fetch_lock = Lock()
+        self.announced = {}  # pull requests expected to be looked up this cycle
+        self.results = {}    # pull request key -> pull request node (or None)
+
+    @staticmethod
+    def pull_request_key(repo_owner, repo_name, number):
+        return f"{repo_owner}/{repo_name}/{number}".lower()
+
+    def announce(self, pull_requests):
+        with self.fetch_lock:
+            for pull_request in pull_requests:
+                key = self.pull_request_key(**pull_request.api_params)
+                if key not in self.results:
+                    self.announced[key] = pull_request.api_params
+
+    def reset(self):
+        with self.fetch_lock:
+            self.announced = {}
+            self.results = {}
+
+    def build_query(self, batch: list):
+        variables, parameters, fields = {}, [], []
+        for index, params in enumerate(batch):
+            variables.update({f"o{index}": params["repo_owner"],
+                              f"n{index}": params["repo_name"],
+                              f"p{index}": int(params["number"])})
+            parameters.append(f"$o{index}: String!, $n{index}: String!, $p{index}: Int!")
+            fields.append(f"pr{index}: repository(owner: $o{index}, name: $n{index}) "
+                          f"{{ pullRequest(number: $p{index}) {{ {self.pull_request_fields} }} }}")
+        query = f"query({', '.join(parameters)}) {{ {' '.join(fields)} }}"
+        return {"query": query, "variables": variables}
+
+    def fetch_batch(self, batch: list):
+        logging.info(f"fetching {len(batch)} pull requests with a single graphql query")
+        response = self.api_call(api_url=f"{self.api_host}/graphql",
+                                 verb="POST",
+                                 data=self.build_query(batch))
+        body = response.json()
+        errors = body.get("errors") or []
+        for error in errors:
+            logging.warning(f"Github GraphQL API error: {error.get('type')} {error.get('message')}")
+        data = body.get("data")
+        if data is None or any(not error.get("path") for error in errors):
+            # the whole query failed (e.g. RATE_LIMITED), the batch is looked up again later
+            raise RequestException(f"github graphql query of {len(batch)} pull requests failed")
+        # aliases which can't be resolved (e.g. deleted or private repositories)
+        unresolved = {error["path"][0] for error in errors
+                      if error.get("type") in self.unresolved_error_types}
+        for index, params in enumerate(batch):
+            alias = f"pr{index}"
+            node = (data.get(alias) or {}).get("pullRequest")
+            if node is not None or alias in unresolved:
+                self.results[self.pull_request_key(**params)] = node
+
+    def get_pull_request_node(self, repo_owner, repo_name, number):
+        key = self.pull_request_key(repo_owner, repo_name, number)
+        with self.fetch_lock:
+            if key not in self.results:
+                # fetch the requested pull request along with other announced ones
+                self.announced.pop(key, None)
+                batch = [{"repo_owner": repo_owner, "repo_name": repo_name, "number": number}]
+                while self.announced and len(batch) < self.batch_size:
+                    batch.append(self.announced.pop(next(iter(self.announced))))
+                self.fetch_batch(batch)
+            if key not in self.results:
+                raise RequestException(f"github graphql lookup of pull request {key} failed")
+            node = self.results[key]
+        if node is None:
+            raise GitGraphQLError(f"pull request {key} could not be resolved")
+        return node
+
+    def get_pull_request(self, repo_owner, repo_name, number,
+                         entity_tag=None, last_modified=None):
+        node = self.get_pull_request_node(repo_owner, repo_name, number)
+        return {
+            "headers": {},
+            "details": {"merged": node.get("merged"), "state": (node.get("state") or "").lower(),
+                        "html_url": node.get("url")}
+        }
+
+    def get_pull_request_reviews(self, repo_owner, repo_name, number, pages: dict = None):
+        node = self.get_pull_request_node(repo_owner, repo_name, number)
+        reviews = (node.get("reviews") or {}).get("nodes") or []
+        return {
+            "headers": {},
+            "reviews": [{"state": review.get("state"), "html_url": review.get("url")}
+                        for review in reviews]
+        }
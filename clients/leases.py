@@ -0,0 +1,211 @@
+from abc import ABC, abstractmethod
+from math import ceil
+from threading import Lock, Thread, Event
+import sqlite3
+import logging
+import fcntl
+import zlib
+import json
+import time
+import os
+
+
+class LeaseBackend(ABC):
+    """ Shared store of named leases, each held by one replica until it expires """
+
+    @abstractmethod
+    def acquire(self, name: str, owner: str, ttl: float):
+        """ Takes a free or expired lease (or renews an owned one), returns True on success """
+
+    @abstractmethod
+    def release(self, name: str, owner: str):
+        pass
+
+    @abstractmethod
+    def leases(self):
+        """ Returns lease name -> (owner, expiry timestamp) """
+
+
+class FileLeaseBackend(LeaseBackend):
+    """ Leases kept in a JSON file, updated under an exclusive file lock """
+
+    def __init__(self, lease_path: str):
+        os.makedirs(lease_path, exist_ok=True)
+        self.file_path = os.path.join(lease_path, "leases.json")
+        self.lock_path = os.path.join(lease_path, "leases.lock")
+        self.lock = Lock()  # flock is per open file, threads of a process are serialized here
+
+    def update(self, func):
+        with self.lock, open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                leases = self.read()
+                result = func(leases)
+                tmp_file_path = f"{self.file_path}.tmp"
+                with open(tmp_file_path, "w") as file:
+                    json.dump(leases, file)
+                os.replace(tmp_file_path, self.file_path)
+                return result
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read(self):
+        if not os.path.exists(self.file_path):
+            return {}
+        with open(self.file_path, "r") as file:
+            return json.load(file)
+
+    def acquire(self, name: str, owner: str, ttl: float):
+        def acquire_lease(leases: dict):
+            holder, expires_at = leases.get(name, (None, 0))
+            if holder not in (None, owner) and expires_at > time.time():
+                return False
+            leases[name] = (owner, time.time() + ttl)
+            return True
+        return self.update(acquire_lease)
+
+    def release(self, name: str, owner: str):
+        def release_lease(leases: dict):
+            if leases.get(name, (None, 0))[0] == owner:
+                leases.pop(name)
+        self.update(release_lease)
+
+    def leases(self):
+        with self.lock:
+            return {name: tuple(lease) for name, lease in self.read().items()}
+
+
+class SQLiteLeaseBackend(LeaseBackend):
+    """ Leases kept in a SQLite table, taken with a single conditional upsert """
+
+    def __init__(self, lease_path: str):
+        os.makedirs(lease_path, exist_ok=True)
+        self.db_path = os.path.join(lease_path, "leases.db")
+        self.lock = Lock()
+        # rollback journal, WAL needs shared memory which network volumes don't provide
+        self.connection = sqlite3.connect(self.db_path, timeout=30,
+                                          check_same_thread=False,
+                                          isolation_level=None)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS leases ("
+                                "name TEXT PRIMARY KEY, "
+                                "owner TEXT NOT NULL, "
+                                "expires_at REAL NOT NULL)")
+
+    def acquire(self, name: str, owner: str, ttl: float):
+        time_now = time.time()
+        with self.lock:
+            self.connection.execute("INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+                                    "ON CONFLICT (name) DO UPDATE SET "
+                                    "owner = excluded.owner, expires_at = excluded.expires_at "
+                                    "WHERE leases.owner = excluded.owner OR leases.expires_at <= ?",
+                                    (name, owner, time_now + ttl, time_now))
+            return self.connection.execute("SELECT changes()").fetchone()[0] == 1
+
+    def release(self, name: str, owner: str):
+        with self.lock:
+            self.connection.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+    def leases(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT name, owner, expires_at FROM leases").fetchall()
+        return {name: (owner, expires_at) for name, owner, expires_at in rows}
+
+
+lease_backends = {
+    "files": FileLeaseBackend,
+    "sqlite": SQLiteLeaseBackend
+}
+
+
+class ShardCoordinator:
+    """ Claims a fair share of shards (channels or pull request hash ranges) through leases """
+
+    def __init__(self, lease_path: str, owner: str, shard_by: str, channels: list,
+                 shard_count: int = 16, ttl: float = 60, backend: str = "sqlite"):
+        logging.info(f"using {backend} lease store at {lease_path} as replica {owner}")
+        self.backend = lease_backends[backend](lease_path)
+        self.owner = owner
+        self.shard_by = shard_by
+        self.ttl = ttl
+        if shard_by == "channel":
+            self.shards = [f"channel/{channel_id}" for channel_id in channels]
+        else:
+            self.shards = [f"shard/{index}" for index in range(shard_count)]
+        self.held = {}  # shard -> lease expiry timestamp
+        self.lock = Lock()
+        self.stopped = Event()
+
+    def shard_of(self, channel_id: str, pull_requests: tuple = ()):
+        if self.shard_by == "channel":
+            return f"channel/{channel_id}"
+        # crc32 is stable across processes, unlike hash()
+        key = min(pull_request.cache_path for pull_request in pull_requests)
+        return f"shard/{zlib.crc32(key.encode()) % len(self.shards)}"
+
+    def owns_shard(self, shard: str):
+        # stop acting well before the lease expires and another replica may take it over
+        with self.lock:
+            return self.held.get(shard, 0) - self.ttl / 3 > time.time()
+
+    def owns(self, item):
+        return self.owns_shard(self.shard_of(item.channel, item.pull_requests))
+
+    def owns_channel(self, channel_id: str):
+        # with pull request shards every replica scans all channels
+        return self.shard_by != "channel" or self.owns_shard(self.shard_of(channel_id))
+
+    def rebalance(self):
+        time_now = time.time()
+        # replicas announce themselves with a lease of their own
+        self.backend.acquire(f"replica/{self.owner}", self.owner, self.ttl)
+        leases = self.backend.leases()
+        replicas = {owner for name, (owner, expires_at) in leases.items()
+                    if name.startswith("replica/") and expires_at > time_now}
+        fair_share = ceil(len(self.shards) / max(len(replicas), 1))
+
+        owned = [shard for shard in self.shards
+                 if leases.get(shard, (None, 0))[0] == self.owner]
+        held = {}
+        with self.lock:
+            previous = set(self.held)
+            # stop acting on surplus shards before other replicas can take them
+            for shard in owned[fair_share:]:
+                self.held.pop(shard, None)
+        for shard in owned[fair_share:]:
+            self.backend.release(shard, self.owner)
+        for shard in owned[:fair_share]:
+            if self.backend.acquire(shard, self.owner, self.ttl):
+                held[shard] = time_now + self.ttl
+        for shard in self.shards:
+            if len(held) >= fair_share:
+                break
+            holder, expires_at = leases.get(shard, (None, 0))
+            if shard not in held and (holder is None or expires_at <= time_now) \
+                    and self.backend.acquire(shard, self.owner, self.ttl):
+                held[shard] = time_now + self.ttl
+
+        with self.lock:
+            self.held = held
+        if set(held) != previous:
+            logging.info(f"replica {self.owner} holds {len(held)} of {len(self.shards)} shards "
+                         f"({len(replicas)} replicas): {sorted(held)}")
+
+    def heartbeat(self):
+        while not self.stopped.wait(self.ttl / 3):
+            try:
+                self.rebalance()
+            except (OSError, sqlite3.Error) as err:
+                logging.warning(f"failed to renew shard leases: {err}")
+
+    def start(self):
+        self.rebalance()
+        Thread(target=self.heartbeat, name="ShardLeases", daemon=True).start()
+
+    def stop(self):
+        # hand shards over to other replicas right away
+        self.stopped.set()
+        with self.lock:
+            held, self.held = self.held, {}
+        for shard in held:
+            self.backend.release(shard, self.owner)
+        self.backend.release(f"replica/{self.owner}", self.owner)
@@ -0,0 +1,220 @@
+"""
+Process-wide metrics in the Prometheus text exposition format, served on `/metrics`:
+
+    python main.py --metrics_port 9100 ...
+    curl http://localhost:9100/metrics
+"""
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from threading import Lock, Thread
+import logging
+import re
+
+
+def format_labels(names: tuple, values: tuple, extra: str = ""):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return f"{{{','.join(pairs)}}}" if pairs else ""
+
+
+class Metric(ABC):
+    """ Labelled metric, children are created on first use of a label combination """
+
+    kind = None
+    family_suffix = ""  # HELP and TYPE lines name the metric as its samples do
+
+    def __init__(self, name: str, description: str, label_names: tuple = ()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.children = {}  # label values -> value (or bucket counts)
+        self.lock = Lock()
+
+    @abstractmethod
+    def samples(self):
+        """ Yields (name suffix, label values, extra label, value) """
+
+    def render(self):
+        family = f"{self.name}{self.family_suffix}"
+        lines = [f"# HELP {family} {self.description}", f"# TYPE {family} {self.kind}"]
+        for suffix, label_values, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(self.label_names, label_values, extra)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+    family_suffix = "_total"
+
+    def inc(self, *label_values, amount: float = 1):
+        with self.lock:
+            self.children[label_values] = self.children.get(label_values, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            children = dict(self.children)
+        for label_values, value in sorted(children.items()):
+            yield "_total", label_values, "", value
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, *label_values):
+        with self.lock:
+            self.children[label_values] = value
+
+    def set_function(self, func, *label_values):
+        # evaluated on every scrape (e.g. queue sizes)
+        with self.lock:
+            self.children[label_values] = func
+
+    def samples(self):
+        with self.lock:
+            children = dict(self.children)
+        for label_values, value in sorted(children.items()):
+            value = value() if callable(value) else value
+            if value is not None:
+                yield "", label_values, "", value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    default_buckets = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name: str, description: str, label_names: tuple = (), buckets: tuple = None):
+        super().__init__(name, description, label_names)
+        self.buckets = tuple(buckets or self.default_buckets)
+
+    def observe(self, value: float, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            # per bucket counts (not cumulative), the last one counts values above all buckets
+            counts, total = self.children.get(label_values, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[index] += 1
+            self.children[label_values] = counts, total + value
+
+    def samples(self):
+        with self.lock:
+            children = {labels: (list(counts), total) for labels, (counts, total) in self.children.items()}
+        for label_values, (counts, total) in sorted(children.items()):
+            cumulative = 0
+            for bucket, count in zip(self.buckets, counts):
+                cumulative += count
+                yield "_bucket", label_values, f'le="{bucket}"', cumulative
+            yield "_bucket", label_values, 'le="+Inf"', cumulative + counts[-1]
+            yield "_sum", label_values, "", total
+            yield "_count", label_values, "", cumulative + counts[-1]
+
+
+class MetricsRegistry:
+    """ Collection of metrics rendered together on scrape """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric: Metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, description: str, label_names: tuple = ()):
+        return self.register(Counter(name, description, label_names))
+
+    def gauge(self, name: str, description: str, label_names: tuple = ()):
+        return self.register(Gauge(name, description, label_names))
+
+    def histogram(self, name: str, description: str, label_names: tuple = (), buckets: tuple = None):
+        return self.register(Histogram(name, description, label_names, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+api_requests = metrics.counter(
+    "pr_vigilante_api_requests",
+    "API requests by client, endpoint and response status",
+    ("client", "endpoint", "status"))
+api_request_duration = metrics.histogram(
+    "pr_vigilante_api_request_duration_seconds",
+    "API request latency by client and endpoint",
+    ("client", "endpoint"))
+github_rate_limit_remaining = metrics.gauge(
+    "pr_vigilante_github_rate_limit_remaining",
+    "GitHub API calls left until the quota is renewed")
+github_rate_limit_limit = metrics.gauge(
+    "pr_vigilante_github_rate_limit_limit",
+    "GitHub API quota per window")
+github_deferred_lookups = metrics.counter(
+    "pr_vigilante_github_deferred_lookups",
+    "Low priority GitHub lookups deferred to save the quota")
+cache_lookups = metrics.counter(
+    "pr_vigilante_cache_lookups",
+    "Cache lookups by result (memory_hit, hit, miss)",
+    ("result",))
+cache_evictions = metrics.counter(
+    "pr_vigilante_cache_evictions",
+    "Cache entries evicted by reason",
+    ("reason",))
+cache_bytes_written = metrics.counter(
+    "pr_vigilante_cache_written_bytes",
+    "Bytes of serialized entries written to the cache store")
+cache_size_bytes = metrics.gauge(
+    "pr_vigilante_cache_size_bytes",
+    "Size of the cache store after the last eviction")
+queue_depth = metrics.gauge(
+    "pr_vigilante_queue_depth",
+    "Work items waiting in the processor queues",
+    ("queue",))
+cycle_duration = metrics.histogram(
+    "pr_vigilante_cycle_duration_seconds",
+    "Duration of publishing cycles, from the channel scan until all queued items are processed",
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1200))
+
+# keeps label values bounded: owners, repositories and numbers are replaced by placeholders
+github_route_pattern = re.compile(r"^.*?/repos/[^/]+/[^/]+/")
+
+
+def github_endpoint(api_url: str):
+    route = github_route_pattern.sub("repos/:owner/:repo/", api_url.split("?")[0])
+    if route == api_url:
+        return route.rpartition("/")[2]  # e.g. graphql
+    return re.sub(r"/\d+(?=/|$)", "/:number", route)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """ Serves the process metrics to Prometheus scrapes """
+
+    def do_GET(self):
+        if self.path.split("?")[0].rstrip("/") != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f"metrics: {format % args}")
+
+
+class MetricsServer:
+    """ Embedded `/metrics` endpoint """
+
+    def __init__(self, port: int):
+        self.port = port
+        self.server = None
+
+    def start(self):
+        self.server = ThreadingHTTPServer(("0.0.0.0", self.port), MetricsHandler)
+        Thread(target=self.server.serve_forever, name="Metrics", daemon=True).start()
+        logging.info(f"serving metrics on port {self.port}")
@@ -0,0 +1,106 @@
+from .github import GitHubClient, GitHubGraphQLClient, RateLimitBudget
+from .slack import SlackClient
+from .cache import CacheClient
+from .traffic import TrafficRecorder, TrafficReplayer
+from threading import Lock
+import argparse
+import logging
+
+
+class ClientRegistry:
+    """ Process-wide registry of shared, thread-safe API and cache clients """
+
+    def __init__(self, args_config: argparse.Namespace):
+        self.config = args_config
+        self.clients = {}
+        self.lock = Lock()
+        # API quotas are shared by every thread calling GitHub, REST and GraphQL calls have their own
+        self.github_budgets = {resource: RateLimitBudget(args_config.github_rate_limit_reserve_percent, resource)
+                               for resource in ("core", "graphql")}
+        # API traffic recorded for (or replayed from) an offline run
+        self.traffic = None
+        if args_config.record:
+            self.traffic = TrafficRecorder(args_config.record, args_config.cache_folder_path)
+        elif args_config.replay:
+            self.traffic = TrafficReplayer(args_config.replay, args_config.replay_latency_scale)
+            self.traffic.seed_cache(args_config.cache_folder_path)
+
+    @property
+    def github_budget(self):
+        return self.github_budgets["graphql" if self.config.github_backend == "graphql" else "core"]
+
+    @property
+    def pool_size(self):
+        # every worker thread may hold one connection at a time
+        return max(self.config.review_workers + self.config.details_workers,
+                   self.config.slack_fetch_workers)
+
+    def get_client(self, name: str, factory):
+        with self.lock:
+            if name not in self.clients:
+                logging.info(f"creating shared {name} client")
+                self.clients[name] = factory()
+            return self.clients[name]
+
+    def attach_traffic(self, client):
+        if self.traffic is not None:
+            if isinstance(client, SlackClient):
+                self.traffic.attach_slack(client)
+            else:
+                self.traffic.attach_github(client)
+        return client
+
+    @property
+    def git_client(self):
+        if self.config.github_backend == "graphql":
+            return self.get_client("github", lambda: self.attach_traffic(GitHubGraphQLClient(
+                api_token=self.config.github_api_token,
+                api_host=self.config.github_api_host,
+                max_retries=self.config.max_client_retries,
+                pool_size=self.pool_size,
+                budget=self.github_budget,
+                batch_size=self.config.github_graphql_batch_size)))
+        return self.get_client("github", lambda: self.attach_traffic(GitHubClient(
+            api_token=self.config.github_api_token,
+            api_host=self.config.github_api_host,
+            max_retries=self.config.max_client_retries,
+            pool_size=self.pool_size,
+            budget=self.github_budget)))
+
+    @property
+    def graphql_client(self):
+        return self.git_client if self.config.github_backend == "graphql" else None
+
+    @property
+    def slack_client(self):
+        return self.get_client("slack", lambda: self.attach_traffic(SlackClient(
+            api_token=self.config.slack_api_token,
+            max_retries=self.config.max_client_retries,
+            requests_per_minute=self.config.slack_requests_per_minute,
+            api_url=self.config.slack_api_url)))
+
+    @property
+    def cache_client(self):
+        # replicas sharing the cache folder read and write it directly, a memory tier
+        # would keep (and write back) entries other replicas updated meanwhile
+        sharded = self.config.shard_by != "none"
+        return self.get_client("cache", lambda: CacheClient(
+            local_dir_path=self.config.cache_folder_path,
+            memory_size=0 if sharded else self.config.cache_memory_size,
+            flush_interval=self.config.cache_flush_interval_seconds,
+            backend=self.config.cache_backend))
+
+    def connection_stats(self):
+        with self.lock:
+            clients = dict(self.clients)
+        return {name: client.connection_stats() for name, client in clients.items()
+                if hasattr(client, "connection_stats")}
+
+    def close(self):
+        with self.lock:
+            cache_client = self.clients.get("cache")
+        if cache_client is not None:
+            # write behind cached entries which were not flushed yet
+            cache_client.close()
+        if isinstance(self.traffic, TrafficRecorder):
+            self.traffic.close()
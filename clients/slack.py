@@ -4,8 +4,12 @@ from slack_sdk.http_retry.builtin_handlers import ConnectionErrorRetryHandler
 
 from datetime import datetime, timedelta
 from functools import wraps
-from utils import sleep_until
+from threading import Lock
+from utils import sleep_until, RateLimiter, log_summary
+from .tracing import tracer
+from . import metrics
 import logging
+import time
 
 
 def set_oldest_ts(minutes: int):
@@ -15,9 +19,10 @@ def set_oldest_ts(minutes: int):
     return str(oldest.timestamp())
 
 
-def set_conv_params(channel: str, minutes: int, latest_ts: str = None):
-    # set oldest_ts ts based on minutes to look back
-    oldest_ts = set_oldest_ts(minutes)
+def set_conv_params(channel: str, minutes: int, latest_ts: str = None, oldest_ts: str = None):
+    # set oldest_ts ts based on minutes to look back (unless a newer one is provided)
+    window_ts = set_oldest_ts(minutes)
+    oldest_ts = oldest_ts if oldest_ts and float(oldest_ts) > float(window_ts) else window_ts
     # set latest_ts to current time if not provided
     latest_ts = latest_ts if latest_ts else str(datetime.now().timestamp())
     params = {
@@ -30,34 +35,69 @@ def set_conv_params(channel: str, minutes: int, latest_ts: str = None):
     return params
 
 
+def has_replies(message: dict):
+    # only thread parents carry reply_count, replies point to the parent's thread_ts
+    message_ts = message.get("ts")
+    return bool(message.get("reply_count")) and \
+        message.get("thread_ts", message_ts) == message_ts
+
+
 def api_rate_control(func):
     @wraps(func)
     def wrapper(self, *args, **kwargs):
+        endpoint = func.__name__.lstrip("_")
         while True:
+            self.throttle(func.__name__)
+            status = "error"
+            started = time.monotonic()
             try:
                 result = func(self, *args, **kwargs)
+                status = "ok"
                 return result
             except SlackApiError as err:
-                if err.response.status_code == 429:
-                    logging.warning("api rate limit hit!")
-                    time_wait = float(err.response.headers["Retry-After"])
-                    sleep_until(time_wait)
-                    continue
-                else:
+                status = str(err.response.status_code)
+                if err.response.status_code != 429:
                     break
+                logging.warning("api rate limit hit!")
+                time_wait = float(err.response.headers["Retry-After"])
+            finally:
+                elapsed = time.monotonic() - started
+                metrics.api_request_duration.observe(elapsed, "slack", endpoint)
+                metrics.api_requests.inc("slack", endpoint, status)
+                tracer.record(f"slack.{endpoint}", elapsed)
+            sleep_until(time_wait)
     return wrapper
 
 
 class SlackClient:
     """ Slack session class """
 
-    def __init__(self, api_token: str, max_retries=1):
+    def __init__(self, api_token: str, max_retries=1, requests_per_minute=0, api_url: str = None):
 
-        self.client = WebClient(api_token)
+        # api_url points the client at another Web API endpoint (e.g. a local stand-in)
+        self.client = WebClient(api_token, base_url=api_url) if api_url else WebClient(api_token)
         conn_error_handler = ConnectionErrorRetryHandler(
             max_retry_count=max_retries)
         self.client.retry_handlers.append(conn_error_handler)
 
+        # Slack rate limits are applied per API method
+        self.requests_per_minute = requests_per_minute
+        self.rate_limiters = {}
+        self.rate_limiters_lock = Lock()
+        self.requests = 0
+
+    def throttle(self, method: str):
+        with self.rate_limiters_lock:
+            if method not in self.rate_limiters:
+                self.rate_limiters[method] = RateLimiter(self.requests_per_minute)
+            rate_limiter = self.rate_limiters[method]
+            self.requests += 1
+        rate_limiter.wait()
+
+    def connection_stats(self):
+        # WebClient opens a new urllib connection for every request
+        return {"requests": self.requests, "connections": self.requests}
+
     @api_rate_control
     def add_message_reaction(self, channel: str, reaction: str, timestamp: str, dry_run: bool):
         if dry_run:
@@ -73,8 +113,9 @@ class SlackClient:
             raise
 
     @api_rate_control
-    def _get_conversation_history(self, channel: str, minutes: int, latest_ts: str = None):
-        params = set_conv_params(channel, minutes, latest_ts)
+    def _get_conversation_history(self, channel: str, minutes: int,
+                                  latest_ts: str = None, oldest_ts: str = None):
+        params = set_conv_params(channel, minutes, latest_ts, oldest_ts)
         try:
             history = self.client.conversations_history(**params)
             return history
@@ -82,14 +123,14 @@ class SlackClient:
             logging.warning(f"error loading conv. history: {err}")
             raise
 
-    def get_conversation_history(self, channel: str, minutes: int):
+    def get_conversation_history(self, channel: str, minutes: int, oldest_ts: str = None):
         messages = []
-        history = self._get_conversation_history(channel, minutes)
+        history = self._get_conversation_history(channel, minutes, oldest_ts=oldest_ts)
         messages.extend(history["messages"])
 
         while history.get("has_more"):
             last_ts = history["messages"][-1]["ts"]
-            history = self._get_conversation_history(channel, minutes, last_ts)
+            history = self._get_conversation_history(channel, minutes, last_ts, oldest_ts)
             messages.extend(history["messages"])
         logging.info(f"fetched {len(messages)} messages")
         return messages
@@ -115,6 +156,7 @@ class SlackClient:
             history = self._get_conversation_replies(
                 channel, minutes, ts, last_ts)
             replies.extend(history["messages"])
-        if len(replies) > 1:
-            logging.info(f"fetched {len(replies)} replies for message {ts}")
+        log_summary.count("thread_replies", len(replies) - 1)
+        if len(replies) > 1 and log_summary.sampled():
+            logging.info("fetched %d replies for message %s", len(replies), ts)
         return replies
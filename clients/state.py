@@ -0,0 +1,246 @@
+from parsers import MessageWorkItem
+from threading import Lock
+import logging
+import json
+import time
+import os
+
+
+class ScanState:
+    """ Slack channel scan state (high-water mark, thread markers, pending messages) """
+
+    def __init__(self, file_path: str, full_scan_cycles: int = 0):
+        self.file_path = file_path
+        self.full_scan_cycles = full_scan_cycles
+        self.cycle = 0
+
+        self.latest_ts = None  # newest message ts seen so far
+        self.threads = {}      # thread ts -> latest_reply marker
+        self.pending = {}      # message ts -> work item still waiting for reactions
+
+        self.load_state()
+
+    def load_state(self):
+        if not os.path.exists(self.file_path):
+            logging.info(f"no scan state found at {self.file_path}")
+            return
+        logging.info(f"loading scan state from {self.file_path}")
+        with open(self.file_path, "r") as file:
+            state = json.load(file)
+        self.latest_ts = state.get("latest_ts")
+        self.threads = state.get("threads", {})
+        self.pending = state.get("pending", {})
+
+    def save_state(self):
+        dir_path = os.path.dirname(self.file_path)
+        if dir_path and not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+        state = {
+            "latest_ts": self.latest_ts,
+            "threads": self.threads,
+            "pending": self.pending
+        }
+        # write to a temporary file first so a crash never leaves a truncated state
+        tmp_file_path = f"{self.file_path}.tmp"
+        with open(tmp_file_path, "w") as file:
+            json.dump(state, file, ensure_ascii=False)
+        os.replace(tmp_file_path, self.file_path)
+        logging.info(f"saved scan state to {self.file_path}: latest ts {self.latest_ts}, "
+                     f"{len(self.threads)} threads, {len(self.pending)} pending messages")
+
+    def is_full_scan(self):
+        if self.latest_ts is None:
+            return True
+        if self.full_scan_cycles and self.cycle % self.full_scan_cycles == 0:
+            return True
+        return False
+
+    def complete_cycle(self):
+        self.cycle += 1
+        self.save_state()
+
+    def expire(self, oldest_ts: str):
+        # forget threads and pending messages which fell out of the time window
+        self.threads = {ts: marker for ts, marker in self.threads.items()
+                        if float(ts) >= float(oldest_ts)}
+        self.pending = {ts: item for ts, item in self.pending.items()
+                        if float(ts) >= float(oldest_ts)}
+
+    def update_latest_ts(self, message_ts: str):
+        if self.latest_ts is None or float(message_ts) > float(self.latest_ts):
+            self.latest_ts = message_ts
+
+    def thread_changed(self, thread_ts: str, latest_reply: str):
+        return self.threads.get(thread_ts) != latest_reply
+
+    def set_thread(self, thread_ts: str, latest_reply: str):
+        self.threads[thread_ts] = latest_reply
+
+    def pending_items(self):
+        return [MessageWorkItem.from_dict(item) for item in self.pending.values()]
+
+    def add_pending(self, item: MessageWorkItem):
+        self.pending[item.ts] = item.to_dict()
+
+    def remove_pending(self, message_ts: str):
+        self.pending.pop(message_ts, None)
+
+
+class ThreadCache:
+    """ In-memory cache of expanded Slack threads keyed by latest_reply """
+
+    def __init__(self):
+        self.threads = {}  # thread ts -> (latest_reply marker, reply work items)
+
+    def get_replies(self, thread_ts: str, latest_reply: str):
+        cached = self.threads.get(thread_ts)
+        if cached and cached[0] == latest_reply:
+            logging.debug(f"thread [{thread_ts}] is unchanged, using cached replies")
+            return cached[1]
+        return None
+
+    def set_replies(self, thread_ts: str, latest_reply: str, replies: tuple):
+        self.threads[thread_ts] = (latest_reply, replies)
+
+    def expire(self, oldest_ts: str):
+        self.threads = {ts: cached for ts, cached in self.threads.items()
+                        if float(ts) >= float(oldest_ts)}
+
+
+class ReactionIndex:
+    """ Thread-safe index of reactions added to messages by processors (or seen in events) """
+
+    def __init__(self):
+        self.reactions = {}  # (channel, message ts) -> reaction names
+        self.lock = Lock()
+
+    def add(self, channel: str, message_ts: str, reaction: str):
+        with self.lock:
+            key = (channel, message_ts)
+            self.reactions[key] = self.reactions.get(key, frozenset()) | {reaction}
+
+    def remove(self, channel: str, message_ts: str, reaction: str):
+        with self.lock:
+            key = (channel, message_ts)
+            self.reactions[key] = self.reactions.get(key, frozenset()) - {reaction}
+
+    def get(self, channel: str, message_ts: str):
+        return self.reactions.get((channel, message_ts), frozenset())
+
+    def expire(self, oldest_ts: str):
+        with self.lock:
+            self.reactions = {key: reactions for key, reactions in self.reactions.items()
+                              if float(key[1]) >= float(oldest_ts)}
+
+
+class PullRequestIndex:
+    """ Thread-safe index of work items by the pull requests they reference """
+
+    def __init__(self):
+        self.items = {}  # pull request cache path -> {(channel, message ts): work item}
+        self.lock = Lock()
+
+    def add(self, item: MessageWorkItem):
+        with self.lock:
+            for pull_request in item.pull_requests:
+                self.items.setdefault(pull_request.cache_path, {})[(item.channel, item.ts)] = item
+
+    def get(self, cache_path: str):
+        with self.lock:
+            return list(self.items.get(cache_path, {}).values())
+
+    def expire(self, oldest_ts: str):
+        with self.lock:
+            items = {}
+            for cache_path, messages in self.items.items():
+                messages = {key: item for key, item in messages.items()
+                            if float(item.ts) >= float(oldest_ts)}
+                if messages:
+                    items[cache_path] = messages
+            self.items = items
+
+
+class PollSchedule:
+    """ Per pull request polling intervals, backing off while nothing changes """
+
+    def __init__(self, file_path: str, base_interval: int, max_interval: int):
+        self.file_path = file_path
+        self.base_interval = base_interval  # seconds
+        self.max_interval = max_interval    # seconds
+        self.polls = {}       # cache folder -> {"interval": seconds, "next_poll": timestamp}
+        self.tombstones = {}  # pull request cache path -> timestamp it was retired at
+        self.skipped = 0
+        self.lock = Lock()
+
+        self.load_state()
+
+    def load_state(self):
+        if not os.path.exists(self.file_path):
+            logging.info(f"no poll schedule found at {self.file_path}")
+            return
+        logging.info(f"loading poll schedule from {self.file_path}")
+        with open(self.file_path, "r") as file:
+            state = json.load(file)
+        self.polls = state.get("polls", {})
+        self.tombstones = state.get("tombstones", {})
+
+    def save_state(self):
+        dir_path = os.path.dirname(self.file_path)
+        if dir_path and not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+        with self.lock:
+            state = {"polls": dict(self.polls), "tombstones": dict(self.tombstones)}
+        tmp_file_path = f"{self.file_path}.tmp"
+        with open(tmp_file_path, "w") as file:
+            json.dump(state, file)
+        os.replace(tmp_file_path, self.file_path)
+
+    def is_retired(self, cache_path: str):
+        # closed pull requests may be reopened, they are looked up again at the longest interval
+        retired = self.tombstones.get(cache_path)
+        return retired is not None and time.time() < retired + max(self.max_interval, self.base_interval)
+
+    def retire(self, cache_path: str):
+        with self.lock:
+            self.tombstones[cache_path] = time.time()
+
+    def is_due(self, cache_folder: str):
+        poll = self.polls.get(cache_folder)
+        # cycles don't start at exact intervals, allow half of the base interval early
+        if poll and time.time() < poll["next_poll"] - self.base_interval / 2:
+            with self.lock:
+                self.skipped += 1
+            return False
+        return True
+
+    def polled(self, cache_folder: str, changed: bool):
+        with self.lock:
+            poll = self.polls.get(cache_folder)
+            if changed or poll is None:
+                interval = self.base_interval
+            else:
+                interval = min(poll["interval"] * 2, max(self.max_interval, self.base_interval))
+            self.polls[cache_folder] = {"interval": interval, "next_poll": time.time() + interval}
+
+    def wake(self, cache_path: str):
+        # a pull request changed (e.g. reported by a webhook), poll it again right away
+        with self.lock:
+            self.polls = {folder: poll for folder, poll in self.polls.items()
+                          if os.path.dirname(folder) != cache_path}
+            self.tombstones.pop(cache_path, None)
+
+    def expire(self, referenced: set):
+        # forget pull requests which are not referenced by messages in the time window
+        with self.lock:
+            self.polls = {folder: poll for folder, poll in self.polls.items()
+                          if os.path.dirname(folder) in referenced}
+            self.tombstones = {path: retired for path, retired in self.tombstones.items()
+                               if path in referenced}
+
+    def complete_cycle(self, referenced: set):
+        self.expire(referenced)
+        self.save_state()
+        with self.lock:
+            skipped, self.skipped = self.skipped, 0
+        logging.info(f"poll schedule: {skipped} lookups of quiet pull requests skipped, "
+                     f"{len(self.polls)} scheduled, {len(self.tombstones)} retired")
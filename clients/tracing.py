@@ -0,0 +1,158 @@
+"""
+Per-cycle timing breakdown and on-demand profiling:
+
+    python main.py --trace_file ./cache/trace.jsonl ...
+    kill -USR1 <pid>   # profile the next --profile_cycles cycles
+    python -m pstats ./cache/profiles/cycle-<n>.pstats
+"""
+from contextlib import contextmanager
+from datetime import datetime
+from threading import Lock, local, current_thread
+import cProfile
+import logging
+import pstats
+import json
+import time
+import os
+
+
+class CycleTracer:
+    """ Aggregates span timings of all threads per cycle, profiles cycles on request """
+
+    def __init__(self):
+        self.trace_file = None
+        self.profile_path = None
+        self.cycle_count = 0
+        self.started = None
+        self.spans = {}         # stage -> [count, seconds, max seconds]
+        self.lock = Lock()
+
+        self.profile_requests = 0  # cycles left to profile
+        self.profiling = False
+        self.profiles = {}         # thread name -> cProfile.Profile
+        self.local = local()
+
+    def configure(self, trace_file: str = None, profile_path: str = None, profile_cycles: int = 0):
+        self.trace_file = trace_file
+        self.profile_path = profile_path
+        self.profile_requests = profile_cycles
+
+    def request_profile(self, cycles: int):
+        # called from signal handlers, no locking
+        self.profile_requests = cycles
+
+    @property
+    def enabled(self):
+        return self.trace_file is not None
+
+    def record(self, stage: str, seconds: float):
+        if not self.enabled:
+            return
+        with self.lock:
+            span = self.spans.setdefault(stage, [0, 0.0, 0.0])
+            span[0] += 1
+            span[1] += seconds
+            span[2] = max(span[2], seconds)
+
+    @contextmanager
+    def span(self, stage: str):
+        if not self.enabled:
+            yield
+            return
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(stage, time.monotonic() - started)
+
+    @contextmanager
+    def profiled(self):
+        """ Profiles the current thread while a cycle is being profiled """
+        if not self.profiling or getattr(self.local, "profiling", False):
+            yield
+            return
+        profile = self.thread_profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # python 3.12+ allows a single active profiler, already covering all threads
+            profile = None
+        if profile is None:
+            yield
+            return
+        self.local.profiling = True
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.local.profiling = False
+
+    def thread_profile(self):
+        name = current_thread().name
+        with self.lock:
+            if name not in self.profiles:
+                self.profiles[name] = cProfile.Profile()
+            return self.profiles[name]
+
+    @contextmanager
+    def cycle(self):
+        self.start_cycle()
+        try:
+            with self.profiled():
+                yield
+        finally:
+            self.end_cycle()
+
+    def start_cycle(self):
+        self.cycle_count += 1
+        self.started = time.time()
+        with self.lock:
+            self.spans = {}
+            self.profiles = {}
+        if self.profile_requests > 0:
+            self.profile_requests -= 1
+            self.profiling = True
+            logging.info(f"profiling cycle {self.cycle_count}")
+
+    def end_cycle(self):
+        duration = time.time() - self.started
+        if self.profiling:
+            self.profiling = False
+            self.dump_profile()
+        if not self.enabled:
+            return
+        with self.lock:
+            spans, self.spans = self.spans, {}
+        trace = {
+            "cycle": self.cycle_count,
+            "started": datetime.fromtimestamp(self.started).isoformat(),
+            "duration": round(duration, 3),
+            # spans of parallel threads overlap, seconds may add up to more than the duration
+            "stages": {stage: {"count": count, "seconds": round(seconds, 3), "max": round(longest, 3)}
+                       for stage, (count, seconds, longest) in sorted(spans.items())}
+        }
+        dir_path = os.path.dirname(self.trace_file)
+        if dir_path and not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+        with open(self.trace_file, "a") as file:
+            file.write(json.dumps(trace) + "\n")
+
+    def dump_profile(self):
+        with self.lock:
+            profiles, self.profiles = self.profiles, {}
+        stats = None
+        for profile in profiles.values():
+            if stats is None:
+                stats = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+        if stats is None:
+            return
+        if not os.path.exists(self.profile_path):
+            os.makedirs(self.profile_path)
+        file_path = os.path.join(self.profile_path, f"cycle-{self.cycle_count}.pstats")
+        stats.dump_stats(file_path)
+        logging.info(f"saved profile of cycle {self.cycle_count} ({len(profiles)} threads) to {file_path}")
+
+
+tracer = CycleTracer()
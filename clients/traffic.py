@@ -0,0 +1,236 @@
+"""
+Recording and offline replay of GitHub and Slack API traffic:
+
+    python main.py --record ./recordings/incident ...
+    python main.py --replay ./recordings/incident --replay_latency_scale 0.5 ...
+
+Exchanges are stored per client as JSON lines (`github.jsonl`, `slack.jsonl`) and replayed
+in the recorded order per request, the Authorization header (and token) is never stored.
+"""
+from slack_sdk.errors import SlackApiError
+from slack_sdk.web import SlackResponse
+
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from collections import deque
+from functools import wraps
+from threading import Lock
+import requests
+import hashlib
+import logging
+import shutil
+import json
+import time
+import os
+
+
+# request parameters identifying Slack calls, time based ones (latest, oldest) change between runs
+slack_key_params = ("channel", "ts", "timestamp", "name", "cursor")
+
+
+def github_key(request: requests.PreparedRequest):
+    # hosts are left out, so a recording can be replayed against any --github_api_host
+    key = f"{request.method} {request.path_url}"
+    if request.body:
+        body = request.body if isinstance(request.body, bytes) else request.body.encode()
+        key += f" {hashlib.sha1(body).hexdigest()[:12]}"
+    return key
+
+
+def slack_arguments(kwargs: dict):
+    arguments = {}
+    for name in ("params", "data", "json"):
+        arguments.update(kwargs.get(name) or {})
+    arguments.pop("token", None)
+    return arguments
+
+
+def slack_key(api_method: str, kwargs: dict):
+    arguments = slack_arguments(kwargs)
+    return f"{api_method} " + json.dumps({name: arguments[name] for name in slack_key_params
+                                          if name in arguments}, sort_keys=True)
+
+
+class TrafficRecorder:
+    """ Stores API requests and responses of the shared clients """
+
+    def __init__(self, dir_path: str, cache_folder_path: str = None):
+        self.dir_path = dir_path
+        self.started = time.monotonic()
+        self.lock = Lock()
+        os.makedirs(dir_path, exist_ok=True)
+        if cache_folder_path and os.path.isdir(cache_folder_path):
+            # replays start from the cache state the recording started with
+            snapshot_path = os.path.join(dir_path, "cache")
+            shutil.rmtree(snapshot_path, ignore_errors=True)
+            # recordings may be kept inside the cache folder
+            recording_path = os.path.abspath(dir_path)
+            shutil.copytree(cache_folder_path, snapshot_path, ignore=lambda path, names: [
+                name for name in names if os.path.abspath(os.path.join(path, name)) == recording_path])
+        self.files = {source: open(os.path.join(dir_path, f"{source}.jsonl"), "w", buffering=1)
+                      for source in ("github", "slack")}
+        logging.info(f"recording api traffic to {dir_path}")
+
+    def record(self, source: str, key: str, request: dict, response: dict, elapsed: float):
+        exchange = {"key": key, "offset": round(time.monotonic() - self.started - elapsed, 6),
+                    "elapsed": round(elapsed, 6), "request": request, "response": response}
+        line = json.dumps(exchange, default=str)
+        with self.lock:
+            self.files[source].write(line + "\n")
+
+    def attach_github(self, git_client):
+        git_client.client.mount(git_client.api_host, RecordingAdapter(git_client.adapter, self))
+
+    def attach_slack(self, slack_client):
+        api_call = slack_client.client.api_call
+
+        @wraps(api_call)
+        def recorded_api_call(api_method: str, **kwargs):
+            started = time.monotonic()
+            try:
+                response = api_call(api_method, **kwargs)
+            except SlackApiError as err:
+                self.record_slack(api_method, kwargs, err.response, time.monotonic() - started)
+                raise
+            self.record_slack(api_method, kwargs, response, time.monotonic() - started)
+            return response
+
+        # WebClient methods (conversations_history, reactions_add, ...) all go through api_call
+        slack_client.client.api_call = recorded_api_call
+
+    def record_slack(self, api_method: str, kwargs: dict, response: SlackResponse, elapsed: float):
+        request = {"api_method": api_method, "http_verb": kwargs.get("http_verb", "POST"),
+                   "arguments": slack_arguments(kwargs)}
+        self.record("slack", slack_key(api_method, kwargs), request, {
+            "status": response.status_code,
+            "headers": dict(response.headers),
+            "data": response.data
+        }, elapsed)
+
+    def close(self):
+        with self.lock:
+            for file in self.files.values():
+                file.close()
+
+
+class RecordingAdapter(BaseAdapter):
+    """ Transport adapter recording the exchanges of the wrapped one """
+
+    def __init__(self, adapter: BaseAdapter, recorder: TrafficRecorder):
+        super().__init__()
+        self.adapter = adapter
+        self.recorder = recorder
+
+    def send(self, request: requests.PreparedRequest, **kwargs):
+        started = time.monotonic()
+        headers = {name: value for name, value in request.headers.items() if name.lower() != "authorization"}
+        body = request.body.decode() if isinstance(request.body, bytes) else request.body
+        recorded_request = {"method": request.method, "url": request.path_url, "headers": headers, "body": body}
+        try:
+            response = self.adapter.send(request, **kwargs)
+            content = response.text  # body is read here, so it counts towards the elapsed time
+        except requests.exceptions.RequestException as err:
+            self.recorder.record("github", github_key(request), recorded_request,
+                                 {"error": str(err)}, time.monotonic() - started)
+            raise
+        self.recorder.record("github", github_key(request), recorded_request, {
+            "status": response.status_code,
+            "reason": response.reason,
+            "headers": dict(response.headers),
+            "body": content
+        }, time.monotonic() - started)
+        return response
+
+    def close(self):
+        self.adapter.close()
+
+
+class TrafficReplayer:
+    """ Serves recorded API responses back in the recorded order, with scaled latency """
+
+    def __init__(self, dir_path: str, latency_scale: float = 1.0):
+        self.dir_path = dir_path
+        self.latency_scale = latency_scale
+        self.exchanges = {}  # (source, key) -> deque of recorded exchanges
+        self.missing = 0
+        self.lock = Lock()
+        for source in ("github", "slack"):
+            file_path = os.path.join(dir_path, f"{source}.jsonl")
+            if not os.path.exists(file_path):
+                continue
+            with open(file_path, "r") as file:
+                for line in file:
+                    exchange = json.loads(line)
+                    self.exchanges.setdefault((source, exchange["key"]), deque()).append(exchange)
+        logging.info(f"replaying {sum(len(exchanges) for exchanges in self.exchanges.values())} "
+                     f"recorded api calls from {dir_path}")
+
+    def seed_cache(self, cache_folder_path: str):
+        # an empty cache folder starts from the snapshot taken when recording started
+        snapshot_path = os.path.join(self.dir_path, "cache")
+        if not os.path.isdir(snapshot_path) or (os.path.isdir(cache_folder_path) and os.listdir(cache_folder_path)):
+            return
+        shutil.copytree(snapshot_path, cache_folder_path, dirs_exist_ok=True)
+        logging.info(f"cache folder {cache_folder_path} seeded from the recorded snapshot")
+
+    def next(self, source: str, key: str):
+        with self.lock:
+            exchanges = self.exchanges.get((source, key))
+            exchange = exchanges.popleft() if exchanges else None
+            if exchange is None:
+                self.missing += 1
+        if exchange is None:
+            logging.warning(f"no recorded {source} response left for {key}")
+            return None
+        if self.latency_scale:
+            time.sleep(exchange["elapsed"] * self.latency_scale)
+        return exchange
+
+    def attach_github(self, git_client):
+        git_client.client.mount(git_client.api_host, ReplayAdapter(self))
+
+    def attach_slack(self, slack_client):
+        client = slack_client.client
+
+        def replayed_api_call(api_method: str, **kwargs):
+            exchange = self.next("slack", slack_key(api_method, kwargs))
+            response = exchange["response"] if exchange else \
+                {"status": 404, "headers": {}, "data": {"ok": False, "error": "not_recorded"}}
+            return SlackResponse(client=client, http_verb=kwargs.get("http_verb", "POST"),
+                                 api_url=f"{client.base_url}{api_method}", req_args=slack_arguments(kwargs),
+                                 data=response["data"], headers=response["headers"],
+                                 status_code=response["status"]).validate()
+
+        client.api_call = replayed_api_call
+
+
+class ReplayAdapter(BaseAdapter):
+    """ Transport adapter answering requests with recorded responses """
+
+    def __init__(self, replayer: TrafficReplayer):
+        super().__init__()
+        self.replayer = replayer
+
+    def send(self, request: requests.PreparedRequest, **kwargs):
+        key = github_key(request)
+        exchange = self.replayer.next("github", key)
+        if exchange is None:
+            raise requests.exceptions.ConnectionError(f"no recorded response for {key}", request=request)
+        recorded = exchange["response"]
+        if "error" in recorded:
+            raise requests.exceptions.ConnectionError(recorded["error"], request=request)
+
+        response = requests.Response()
+        response.status_code = recorded["status"]
+        response.reason = recorded.get("reason")
+        response.headers = CaseInsensitiveDict(recorded["headers"])
+        # the recorded body is already decoded
+        response.headers.pop("Content-Encoding", None)
+        response._content = recorded["body"].encode()
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
@@ -0,0 +1,74 @@
+"""
+Synthetic channels and pull requests served by the local Slack and GitHub stand-ins
+"""
+import random
+import time
+
+
+def message_blocks(text: str, urls: list):
+    elements = [{"type": "text", "text": text}]
+    for url in urls:
+        elements.extend([{"type": "text", "text": " "}, {"type": "link", "url": url}])
+    return [{"type": "rich_text", "block_id": "b0",
+             "elements": [{"type": "rich_text_section", "elements": elements}]}]
+
+
+def pull_request_url(index: int, repositories: int):
+    return f"https://github.com/bench/repo-{index % repositories}/pull/{index + 1}"
+
+
+def generate_pull_requests(count: int, repositories: int = 10, approved_ratio: float = 0.5,
+                           merged_ratio: float = 0.3, review_pages: int = 1, seed: int = 0):
+    """ Returns pull request key (owner/repo/number) -> state """
+    rand = random.Random(seed)
+    pull_requests = {}
+    for index in range(count):
+        owner, repo, _, number = pull_request_url(index, repositories).split("/")[3:]
+        pull_requests[f"{owner}/{repo}/{number}"] = {
+            "approved": rand.random() < approved_ratio,
+            "merged": rand.random() < merged_ratio,
+            "review_pages": review_pages
+        }
+    return pull_requests
+
+
+def generate_channels(channels: int, messages: int, time_window_minutes: int, pull_requests: int,
+                      repositories: int = 10, thread_ratio: float = 0.2, replies: int = 5,
+                      links_per_message: int = 1, seed: int = 0):
+    """ Returns channel id -> {"messages": [...] newest first, "replies": {thread ts: [...]}} """
+    rand = random.Random(seed)
+    # keep all messages inside the time window for the whole benchmark
+    newest, spread = time.time() - 60, time_window_minutes * 60 / 2
+    data = {}
+    for channel in range(channels):
+        history, threads = [], {}
+        for index in range(messages):
+            ts = f"{newest - spread * index / max(messages, 1):.6f}"
+            urls = [pull_request_url(rand.randrange(pull_requests), repositories)
+                    for _ in range(links_per_message)]
+            message = {"type": "message", "ts": ts, "text": "please review",
+                       "blocks": message_blocks("please review", urls)}
+            if replies and rand.random() < thread_ratio:
+                thread = [{**message, "thread_ts": ts}]
+                for reply in range(replies):
+                    reply_ts = f"{float(ts) + (reply + 1) / 1000:.6f}"
+                    url = pull_request_url(rand.randrange(pull_requests), repositories)
+                    thread.append({"type": "message", "ts": reply_ts, "thread_ts": ts, "text": "and this",
+                                   "blocks": message_blocks("and this", [url])})
+                message.update({"thread_ts": ts, "reply_count": replies, "latest_reply": thread[-1]["ts"]})
+                threads[ts] = thread
+            history.append(message)
+        data[f"CBENCH{channel:04d}"] = {"messages": history, "replies": threads}
+    return data
+
+
+def referenced_pull_requests(channels: dict):
+    urls = set()
+    for channel in channels.values():
+        for messages in [channel["messages"], *channel["replies"].values()]:
+            for message in messages:
+                for block in message["blocks"]:
+                    for section in block["elements"]:
+                        urls.update(element["url"] for element in section["elements"]
+                                    if element["type"] == "link")
+    return urls
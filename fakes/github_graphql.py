@@ -0,0 +1,87 @@
+"""
+Local stand-in for the GitHub GraphQL API, serving pull request states
+from a JSON file so the graphql backend can be exercised offline:
+
+    python -m fakes.github_graphql --port 8081 --data_file ./prs.json
+    python main.py --github_backend graphql --github_api_host http://localhost:8081 ...
+
+Data file format:
+    {"owner/repo/1": {"merged": false, "reviews": ["COMMENTED", "APPROVED"]}}
+"""
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import argparse
+import logging
+import json
+import time
+import re
+
+
+class FakeGraphQLHandler(BaseHTTPRequestHandler):
+    """ Resolves aliased pull request lookups sent by GitHubGraphQLClient """
+
+    pull_requests = {}
+    latency = 0.0
+    alias_pattern = re.compile(r"(pr\d+): repository\(owner: \$(o\d+), name: \$(n\d+)\) "
+                               r"\{ pullRequest\(number: \$(p\d+)\)")
+
+    def resolve(self, owner: str, name: str, number: int):
+        state = self.pull_requests.get(f"{owner}/{name}/{number}".lower())
+        if state is None:
+            return None
+        url = f"https://github.com/{owner}/{name}/pull/{number}"
+        return {"pullRequest": {
+            "url": url,
+            "merged": state.get("merged", False),
+            "reviews": {"nodes": [{"state": review_state, "url": f"{url}#review"}
+                                  for review_state in state.get("reviews", [])[-1:]]}
+        }}
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/graphql":
+            self.send_error(404)
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        variables = request.get("variables", {})
+        if self.latency:
+            time.sleep(self.latency)
+
+        data, errors = {}, []
+        for alias, owner, name, number in self.alias_pattern.findall(request.get("query", "")):
+            data[alias] = self.resolve(variables[owner], variables[name], variables[number])
+            if data[alias] is None:
+                errors.append({"type": "NOT_FOUND", "path": [alias],
+                               "message": f"Could not resolve to a Repository with the name "
+                                          f"'{variables[owner]}/{variables[name]}'."})
+
+        body = json.dumps({"data": data, "errors": errors} if errors else {"data": data}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("x-ratelimit-limit", "5000")
+        self.send_header("x-ratelimit-remaining", "4999")
+        self.send_header("x-ratelimit-used", "1")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f"fake graphql: {format % args}")
+
+
+def serve(port: int, pull_requests: dict, latency: float = 0.0):
+    FakeGraphQLHandler.pull_requests = {key.lower(): value for key, value in pull_requests.items()}
+    FakeGraphQLHandler.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeGraphQLHandler)
+    logging.info(f"serving fake github graphql api on http://127.0.0.1:{server.server_port}/graphql")
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--data_file", type=str, required=True)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    with open(args.data_file, "r") as file:
+        serve(args.port, json.load(file)).serve_forever()
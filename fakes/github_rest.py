@@ -0,0 +1,133 @@
+"""
+Local stand-in for the GitHub REST endpoints used by GitHubClient
+(pull request details and review pages), with conditional requests:
+
+    python main.py --github_api_host http://127.0.0.1:<port> ...
+
+Pull requests are generated by fakes.dataset.
+"""
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qsl
+from threading import Lock
+import logging
+import random
+import json
+import time
+import re
+
+
+class FakeGitHubRestHandler(BaseHTTPRequestHandler):
+    """ Serves pull request details and reviews with ETags and rate limit headers """
+
+    protocol_version = "HTTP/1.1"  # keep-alive, like api.github.com
+
+    pull_requests = {}        # owner/repo/number -> {"approved", "merged", "review_pages"}
+    latency = 0.0             # seconds added to every response
+    not_modified_rate = 0.0   # chance of answering a matching If-None-Match with 304
+    rate_limit_every = 0      # answer every n-th request with 429 and an exhausted quota
+    rate_limit = 100000
+    requests = 0
+    versions = {}             # resource path -> version, bumped on every changed answer
+    random = random.Random(0)
+    lock = Lock()
+
+    route_pattern = re.compile(r"^/repos/([^/]+)/([^/]+)/pulls/(\d+)(/reviews)?$")
+
+    def respond(self, status: int, body=None, headers: dict = None):
+        data = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def details(self, key: str, state: dict):
+        owner, repo, number = key.split("/")
+        return {
+            "number": int(number),
+            "html_url": f"https://github.com/{owner}/{repo}/pull/{number}",
+            "state": "closed" if state["merged"] else "open",
+            "merged": state["merged"],
+            "title": f"Change {number} of {owner}/{repo}",
+            "user": {"login": "author"}
+        }
+
+    def reviews(self, key: str, state: dict, page: int, per_page: int):
+        owner, repo, number = key.split("/")
+        pages = state["review_pages"]
+        if page > pages:
+            return []
+        url = f"https://github.com/{owner}/{repo}/pull/{number}"
+        reviews = [{"state": "COMMENTED", "html_url": f"{url}#review-{page}-{index}",
+                    "user": {"login": f"reviewer-{index % 5}"}} for index in range(per_page)]
+        if page == pages:
+            reviews = reviews[:3]
+            if state["approved"]:
+                reviews[-1]["state"] = "APPROVED"
+        return reviews
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = dict(parse_qsl(url.query))
+        match = self.route_pattern.match(url.path)
+        with self.lock:
+            FakeGitHubRestHandler.requests += 1
+            rate_limited = self.rate_limit_every and self.requests % self.rate_limit_every == 0
+            remaining = max(self.rate_limit - self.requests, 0)
+        if self.latency:
+            time.sleep(self.latency)
+        headers = {"x-ratelimit-limit": str(self.rate_limit),
+                   "x-ratelimit-reset": str(int(time.time()) + 3600)}
+        if rate_limited:
+            headers.update({"x-ratelimit-remaining": "0", "x-ratelimit-reset": str(int(time.time()) + 1)})
+            self.respond(429, {"message": "API rate limit exceeded"}, headers)
+            return
+        headers["x-ratelimit-remaining"] = str(remaining)
+
+        key = "/".join(match.groups()[:3]).lower() if match else None
+        if key not in self.pull_requests:
+            self.respond(404, {"message": "Not Found"}, headers)
+            return
+        state = self.pull_requests[key]
+        page, per_page = int(query.get("page", 1)), int(query.get("per_page", 30))
+        resource = f"{url.path}?page={page}"
+
+        with self.lock:
+            version = self.versions.setdefault(resource, 1)
+            etag = f'"{key}-{page}-{version}"'
+            not_modified = self.headers.get("If-None-Match") == etag \
+                and self.random.random() < self.not_modified_rate
+            if self.headers.get("If-None-Match") == etag and not not_modified:
+                # answered as changed, e.g. a new comment
+                version = self.versions[resource] = version + 1
+                etag = f'"{key}-{page}-{version}"'
+        headers["ETag"] = etag
+        if not_modified:
+            self.respond(304, headers=headers)
+            return
+
+        if match.group(4):
+            body = self.reviews(key, state, page, per_page)
+            pages = state["review_pages"]
+            if pages > 1:
+                headers["Link"] = f'<http://{self.headers.get("Host")}{url.path}?page={pages}' \
+                                  f'&per_page={per_page}>; rel="last"'
+        else:
+            body = self.details(key, state)
+        self.respond(200, body, headers)
+
+    def log_message(self, format, *args):
+        logging.debug(f"fake github: {format % args}")
+
+
+def serve(port: int, pull_requests: dict, latency: float = 0.0, not_modified_rate: float = 0.0,
+          rate_limit_every: int = 0):
+    FakeGitHubRestHandler.pull_requests = {key.lower(): value for key, value in pull_requests.items()}
+    FakeGitHubRestHandler.latency = latency
+    FakeGitHubRestHandler.not_modified_rate = not_modified_rate
+    FakeGitHubRestHandler.rate_limit_every = rate_limit_every
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeGitHubRestHandler)
+    logging.info(f"serving fake github rest api on http://127.0.0.1:{server.server_port}")
+    return server
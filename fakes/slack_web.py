@@ -0,0 +1,126 @@
+"""
+Local stand-in for the Slack Web API methods used by SlackClient
+(conversations.history, conversations.replies and reactions.add):
+
+    python main.py --slack_api_url http://127.0.0.1:<port>/api/ ...
+
+Channels are generated by fakes.dataset, reactions are kept in memory.
+"""
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qsl
+from threading import Lock
+import logging
+import json
+import time
+
+
+class FakeSlackHandler(BaseHTTPRequestHandler):
+    """ Serves channel history, thread replies and reactions """
+
+    channels = {}          # channel id -> {"messages": [...] newest first, "replies": {ts: [...]}}
+    latency = 0.0          # seconds added to every response
+    rate_limit_every = 0   # answer every n-th request with 429
+    requests = 0
+    lock = Lock()
+
+    def params(self):
+        url = urlparse(self.path)
+        params = dict(parse_qsl(url.query))
+        length = int(self.headers.get("Content-Length", 0))
+        if length:
+            body = self.rfile.read(length).decode()
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                params.update(json.loads(body))
+            else:
+                params.update(parse_qsl(body))
+        return url.path.rstrip("/").rpartition("/")[2], params
+
+    def respond(self, status: int, body: dict, headers: dict = None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    @staticmethod
+    def in_range(message: dict, params: dict):
+        ts = float(message["ts"])
+        return float(params.get("oldest", 0)) <= ts <= float(params.get("latest", "inf"))
+
+    def history(self, params: dict):
+        channel = self.channels.get(params.get("channel"))
+        if channel is None:
+            return {"ok": False, "error": "channel_not_found"}
+        limit = int(params.get("limit", 100))
+        messages = [message for message in channel["messages"] if self.in_range(message, params)]
+        return {"ok": True, "messages": messages[:limit], "has_more": len(messages) > limit}
+
+    def replies(self, params: dict):
+        channel = self.channels.get(params.get("channel"))
+        if channel is None:
+            return {"ok": False, "error": "channel_not_found"}
+        thread = channel["replies"].get(params.get("ts"), [])
+        limit = int(params.get("limit", 100))
+        # the parent message is always returned first
+        messages = thread[:1] + [reply for reply in thread[1:] if self.in_range(reply, params)]
+        return {"ok": True, "messages": messages[:limit], "has_more": len(messages) > limit}
+
+    def add_reaction(self, params: dict):
+        channel = self.channels.get(params.get("channel"))
+        if channel is None:
+            return {"ok": False, "error": "channel_not_found"}
+        ts, name = params.get("timestamp"), params.get("name")
+        messages = channel["messages"] + [reply for thread in channel["replies"].values() for reply in thread]
+        # parents are kept in both the history and their thread
+        targets = [message for message in messages if message["ts"] == ts]
+        if not targets:
+            return {"ok": False, "error": "message_not_found"}
+        reactions = targets[0].setdefault("reactions", [])
+        if any(reaction["name"] == name for reaction in reactions):
+            return {"ok": False, "error": "already_reacted"}
+        for message in targets:
+            message.setdefault("reactions", []).append({"name": name, "count": 1, "users": ["UBENCH"]})
+        return {"ok": True}
+
+    def handle_method(self):
+        method, params = self.params()
+        with self.lock:
+            FakeSlackHandler.requests += 1
+            rate_limited = self.rate_limit_every and self.requests % self.rate_limit_every == 0
+        if self.latency:
+            time.sleep(self.latency)
+        if rate_limited:
+            self.respond(429, {"ok": False, "error": "ratelimited"}, {"Retry-After": "1"})
+            return
+        handlers = {
+            "conversations.history": self.history,
+            "conversations.replies": self.replies,
+            "reactions.add": self.add_reaction
+        }
+        if method not in handlers:
+            self.respond(404, {"ok": False, "error": "unknown_method"})
+            return
+        with self.lock:
+            body = json.loads(json.dumps(handlers[method](params)))
+        self.respond(200, body)
+
+    def do_GET(self):
+        self.handle_method()
+
+    def do_POST(self):
+        self.handle_method()
+
+    def log_message(self, format, *args):
+        logging.debug(f"fake slack: {format % args}")
+
+
+def serve(port: int, channels: dict, latency: float = 0.0, rate_limit_every: int = 0):
+    FakeSlackHandler.channels = channels
+    FakeSlackHandler.latency = latency
+    FakeSlackHandler.rate_limit_every = rate_limit_every
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeSlackHandler)
+    logging.info(f"serving fake slack web api on http://127.0.0.1:{server.server_port}/api/")
+    return server
@@ -1,79 +1,344 @@
-from clients import SlackClient
-from parsers import MessagePullRequestUrlParser
-from processors.helpers import lookup_reaction
-from utils import get_arguments, SafeScheduler
+from clients import SlackClient, ScanState, ThreadCache, ReactionIndex, ClientRegistry,\
+    PollSchedule, PullRequestIndex, ShardCoordinator
+from clients.slack import set_oldest_ts, has_replies
+from clients import metrics
+from clients.tracing import tracer
+from parsers import parse_work_item
+from utils import get_arguments, exit_on_sigterm, SafeScheduler, RequestCoalescer, SlackChannel,\
+    configure_logging, log_summary
 from processors import PullRequestDetails,\
     PullRequestReview
+from processors.helpers import evict_cached_data
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import argparse
 import queue
 import logging
+import signal
 import time
+import os
+
+
+def parse_message(message: dict, channel_id: str):
+    with tracer.span("parse"):
+        return parse_work_item(message, channel_id)
+
+
+@tracer.span("reply_expansion")
+@tracer.profiled()
+def expand_message(slack_client: SlackClient, channel_id: str, time_window: int, message: dict,
+                   thread_cache: ThreadCache, scan_state: ScanState = None):
+    message_ts = message["ts"]
+    # history holds the most recent copy of the parent message
+    items = [parse_message(message, channel_id)]
+    if not has_replies(message):
+        return items
+
+    latest_reply = message.get("latest_reply")
+    replies = thread_cache.get_replies(message_ts, latest_reply)
+    if replies is None:
+        if scan_state is not None and not scan_state.thread_changed(message_ts, latest_reply):
+            # unchanged since the persisted marker, pending replies are kept in the scan state
+            return items
+        messages = slack_client.get_conversation_replies(channel_id, time_window, message_ts)
+        replies = tuple(item for item in (parse_message(reply, channel_id) for reply in messages)
+                        if item.ts != message_ts and item.pull_requests)
+        thread_cache.set_replies(message_ts, latest_reply, replies)
+        if scan_state is not None:
+            scan_state.set_thread(message_ts, latest_reply)
+
+    return items + list(replies)
+
+
+def expand_messages(slack_client: SlackClient, channel_id: str, time_window: int, messages: list,
+                    thread_cache: ThreadCache, fetch_workers: int, scan_state: ScanState = None):
+    with ThreadPoolExecutor(max_workers=fetch_workers,
+                            thread_name_prefix="SlackFetch") as executor:
+        futures = []
+        for message in messages:
+            # messages without threads are streamed right away
+            if not has_replies(message):
+                yield parse_message(message, channel_id)
+                continue
+            futures.append(executor.submit(expand_message, slack_client, channel_id,
+                                           time_window, message, thread_cache, scan_state))
+        for future in as_completed(futures):
+            for item in future.result():
+                yield item
 
 
-def generate_messages(slack_api_token: str, channel_id: str, time_window: int, max_retries: int,):
-    slack_client = SlackClient(api_token=slack_api_token, max_retries=max_retries)
+def generate_incremental_items(slack_client: SlackClient, channel_id: str, time_window: int,
+                               thread_cache: ThreadCache, fetch_workers: int, scan_state: ScanState):
+    scan_state.expire(set_oldest_ts(time_window))
+    # only fetch top-level messages newer than the high-water mark,
+    # unless a full scan of the window is due to catch up on old threads
+    oldest_ts = None if scan_state.is_full_scan() else scan_state.latest_ts
     messages = slack_client.get_conversation_history(channel_id,
-                                                     time_window)
+                                                     time_window,
+                                                     oldest_ts)
     for message in messages:
-        message_ts = message["ts"]
-        replies = slack_client.get_conversation_replies(channel_id, time_window, message_ts)
-        for reply in replies:
-            yield reply
+        scan_state.update_latest_ts(message["ts"])
 
+    refreshed = set()
+    items = expand_messages(slack_client, channel_id, time_window, messages,
+                            thread_cache, fetch_workers, scan_state)
+    for item in items:
+        refreshed.add(item.ts)
+        yield item
 
-def publish_to_queues(config: argparse.Namespace, reviews_queue: queue.Queue, details_queue: queue.Queue):
-    messages = generate_messages(config.slack_api_token, config.slack_channel_id,
-                                 config.slack_time_window_minutes, config.max_client_retries)
-    for message in messages:
-        parser = MessagePullRequestUrlParser(message)
+    # re-check pending PR messages which were not refreshed by this scan
+    for item in scan_state.pending_items():
+        if item.ts not in refreshed:
+            yield item
+
+
+def generate_work_items(config: argparse.Namespace, slack_client: SlackClient, channel: SlackChannel,
+                        thread_cache: ThreadCache, scan_state: ScanState = None):
+    channel_id = channel.channel_id
+    time_window = channel.time_window_minutes
+    thread_cache.expire(set_oldest_ts(time_window))
+    if scan_state is not None:
+        yield from generate_incremental_items(slack_client, channel_id, time_window, thread_cache,
+                                              config.slack_fetch_workers, scan_state)
+        return
+
+    messages = slack_client.get_conversation_history(channel_id,
+                                                     time_window)
+    yield from expand_messages(slack_client, channel_id, time_window, messages,
+                               thread_cache, config.slack_fetch_workers)
+
+
+@tracer.cycle()
+def publish_to_queues(config: argparse.Namespace, reviews_queue: queue.Queue, details_queue: queue.Queue,
+                      registry: ClientRegistry, coalescer: RequestCoalescer, reaction_index: ReactionIndex,
+                      thread_caches: dict, scan_states: dict = None,
+                      poll_schedule: PollSchedule = None, pull_request_index: PullRequestIndex = None,
+                      shards: ShardCoordinator = None):
+    cycle_started = time.monotonic()
+    graphql_client = registry.graphql_client
+    # lookups made between cycles (webhooks, events) may be outdated already
+    coalescer.start_cycle()
+    if graphql_client is not None:
+        graphql_client.reset()
+    channels = config.slack_channels.values()
+    oldest_ts = set_oldest_ts(max(channel.time_window_minutes for channel in channels))
+    reaction_index.expire(oldest_ts)
+    if pull_request_index is not None:
+        pull_request_index.expire(oldest_ts)
 
-        # skip processing these messages (usually caused by no access to repos).
-        if parser.pull_requests and lookup_reaction(
-                message, config.slack_github_error_reaction_name):
+    referenced = set()  # pull requests referenced by messages in the time windows
+    scanned = []
+    for channel in channels:
+        if shards is not None and not shards.owns_channel(channel.channel_id):
             continue
+        scanned.append(channel.channel_id)
+        scan_state = scan_states.get(channel.channel_id) if scan_states else None
+        if scan_state is not None and shards is not None and shards.shard_by == "channel":
+            # the channel may have been scanned by another replica since
+            scan_state.load_state()
+        items = generate_work_items(config, registry.slack_client, channel,
+                                    thread_caches[channel.channel_id], scan_state)
+        for item in items:
+            if not item.pull_requests:
+                continue
+            referenced.update(pull_request.cache_path for pull_request in item.pull_requests)
+            # add reactions processors made since the message was fetched
+            if shards is not None and not shards.owns(item):
+                # handled by the replica holding the message's shard
+                continue
+            item = item.with_reactions(reaction_index.get(item.channel, item.ts))
+            if pull_request_index is not None:
+                # lets webhook events find the messages referencing a pull request
+                pull_request_index.add(item)
 
-        if parser.pull_requests and not lookup_reaction(
-                message, config.slack_approved_reaction_name):
-            reviews_queue.put(message)
-        if parser.pull_requests and not lookup_reaction(
-                message, config.slack_merged_reaction_name):
-            details_queue.put(message)
+            # skip processing these messages (usually caused by no access to repos).
+            if item.lookup_reaction(channel.github_error_reaction_name):
+                if scan_state is not None:
+                    scan_state.remove_pending(item.ts)
+                continue
 
+            if graphql_client is not None:
+                # let the graphql client batch these pull requests with others
+                graphql_client.announce(item.pull_requests)
+
+            # pull requests referenced from several channels are looked up once per cycle
+            pending = False
+            if not item.lookup_reaction(channel.approved_reaction_name):
+                reviews_queue.put(item)
+                pending = True
+            if not item.lookup_reaction(channel.merged_reaction_name):
+                details_queue.put(item)
+                pending = True
+
+            if scan_state is not None:
+                if pending:
+                    scan_state.add_pending(item)
+                else:
+                    scan_state.remove_pending(item.ts)
+
+    tracer.record("scan", time.monotonic() - cycle_started)
     # block main thread until all tasks are processed by workers
-    reviews_queue.join()
-    details_queue.join()
+    with tracer.span("processing"):
+        reviews_queue.join()
+        details_queue.join()
+
+    saved_calls = coalescer.reset()
+    logging.info(f"github lookups saved by request coalescing: {saved_calls}")
+    if graphql_client is not None:
+        graphql_client.reset()
+
+    budget = registry.github_budget.summary()
+    logging.info(f"github api quota remaining: {budget['remaining']} / limit {budget['limit']}, "
+                 f"lookups deferred: {budget['deferred']}")
+    for name, stats in registry.connection_stats().items():
+        logging.info(f"{name} client connections: {stats['connections']} "
+                     f"opened for {stats['requests']} requests")
 
+    # other replicas' channels are not scanned here, their entries are left to them
+    channel_sharded = shards is not None and shards.shard_by == "channel"
+    with tracer.span("eviction"):
+        evict_cached_data(config, registry.cache_client, None if channel_sharded else referenced)
+
+    with tracer.span("state"):
+        for channel_id in scanned:
+            if scan_states:
+                scan_states[channel_id].complete_cycle()
+        if poll_schedule is not None:
+            poll_schedule.complete_cycle(referenced)
+
+    cycle_duration = time.monotonic() - cycle_started
+    metrics.cycle_duration.observe(cycle_duration)
+    logging.info(f"cycle completed in {cycle_duration:.1f}s")
+    log_summary.flush()
     return None
 
 
+def start_processors(config: argparse.Namespace, reviews_queue: queue.Queue, details_queue: queue.Queue,
+                     registry: ClientRegistry, coalescer: RequestCoalescer, reaction_index: ReactionIndex,
+                     poll_schedule: PollSchedule = None, shards: ShardCoordinator = None):
+    processors = []
+    for index in range(config.review_workers):
+        processors.append(PullRequestReview(config, reviews_queue, registry,
+                                            coalescer, reaction_index, poll_schedule, shards))
+    for index in range(config.details_workers):
+        processors.append(PullRequestDetails(config, details_queue, registry,
+                                             coalescer, reaction_index, poll_schedule, shards))
+
+    for index, processor in enumerate(processors):
+        processor.name = f"{processor.name}-{index}"
+        processor.start()
+    return processors
+
+
 def main():
     args = get_arguments()
-    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
-                        format="%(asctime)s - "
-                               "%(threadName)s - "
-                               "%(levelname)s "
-                               "%(message)s")
+    configure_logging(logging.DEBUG if args.debug else logging.INFO, args.log_format)
+    # per-item lines are sampled, their counts are logged once per cycle
+    log_summary.configure(1.0 if args.debug else args.log_sample_rate)
 
-    reviews_queue = queue.Queue()  # PRs requiring approval
-    details_queue = queue.Queue()  # PRs details (merged or not)
+    coalescer = RequestCoalescer()  # shared GitHub lookups within a cycle
+    reaction_index = ReactionIndex()  # reactions added by processors
+    # threads are cached per channel, message ts are only unique within a channel
+    thread_caches = {channel_id: ThreadCache() for channel_id in args.slack_channels}
 
-    processor_approve = PullRequestReview(args, reviews_queue)
-    processor_merging = PullRequestDetails(args, details_queue)
+    # clients are created once and shared by the producer and all processors,
+    # so connections are kept alive and eviction covers a single memory tier
+    registry = ClientRegistry(args)
 
-    processor_approve.start()
-    processor_merging.start()
+    tracer.configure(trace_file=args.trace_file,
+                     profile_path=args.profile_path or os.path.join(args.cache_folder_path, "profiles"),
+                     profile_cycles=args.profile_cycles if args.profile_on_start else 0)
 
     scheduler = SafeScheduler(reschedule_on_failure=True)
+    shards = None
+
+    if args.metrics_port:
+        metrics.MetricsServer(args.metrics_port).start()
+
+    if args.engine == "asyncio":
+        # imported here, so the threaded engine doesn't require aiohttp
+        from processors.async_engine import AsyncEngine
+        if args.slack_incremental_scan or args.github_backend != "rest" or args.shard_by != "none":
+            logging.warning("incremental scanning, sharding and the graphql backend "
+                            "are not supported by the asyncio engine")
+        if args.record or args.replay:
+            logging.warning("recording and replaying api traffic is not supported by the asyncio engine")
+        engine = AsyncEngine(args, registry.cache_client, reaction_index, thread_caches)
+        scheduler.every(args.sleep_period_minutes).minutes.do(engine.publish)
+    else:
+        reviews_queue = queue.Queue()  # PRs requiring approval
+        details_queue = queue.Queue()  # PRs details (merged or not)
+        metrics.queue_depth.set_function(reviews_queue.qsize, "reviews")
+        metrics.queue_depth.set_function(details_queue.qsize, "details")
+
+        if args.shard_by != "none":
+            # replicas claim channels or pull request hash ranges through shared leases
+            shards = ShardCoordinator(
+                lease_path=args.lease_path or os.path.join(args.cache_folder_path, "leases"),
+                owner=args.replica_id,
+                shard_by=args.shard_by,
+                channels=list(args.slack_channels),
+                shard_count=args.shard_count,
+                ttl=args.lease_ttl_seconds,
+                backend=args.lease_backend
+            )
+            shards.start()
+        # files written by a single replica only
+        replica_suffix = f"_{args.replica_id}" if shards is not None else ""
+
+        poll_schedule = None
+        if args.github_max_poll_interval_minutes:
+            poll_schedule = PollSchedule(
+                file_path=os.path.join(args.cache_folder_path, f"github_poll_schedule{replica_suffix}.json"),
+                base_interval=args.sleep_period_minutes * 60,
+                max_interval=args.github_max_poll_interval_minutes * 60
+            )
+
+        start_processors(args, reviews_queue, details_queue, registry,
+                         coalescer, reaction_index, poll_schedule, shards)
+
+        pull_request_index = None
+        if args.github_webhook_port or args.slack_events_port:
+            # imported here, webhooks and events are optional
+            from receivers import GitHubWebhookReceiver, SlackEventsReceiver
+            pull_request_index = PullRequestIndex()
+            if args.github_webhook_port:
+                GitHubWebhookReceiver(args, registry, reviews_queue, details_queue, coalescer,
+                                      reaction_index, pull_request_index, poll_schedule).start()
+            if args.slack_events_port:
+                SlackEventsReceiver(args, registry, reviews_queue, details_queue,
+                                    reaction_index, pull_request_index, shards).start()
+
+        scan_states = None
+        if args.slack_incremental_scan:
+            # channel shards hand their scan state over to the next owner
+            state_suffix = replica_suffix if args.shard_by == "pull_request" else ""
+            scan_states = {channel_id: ScanState(
+                file_path=os.path.join(args.cache_folder_path,
+                                       f"slack_scan_state_{channel_id}{state_suffix}.json"),
+                full_scan_cycles=args.slack_full_scan_cycles
+            ) for channel_id in args.slack_channels}
+
+        scheduler.every(args.sleep_period_minutes).minutes.do(
+            publish_to_queues, args, reviews_queue, details_queue,
+            registry, coalescer, reaction_index, thread_caches, scan_states, poll_schedule,
+            pull_request_index, shards
+        )
 
-    scheduler.every(args.sleep_period_minutes).minutes.do(
-        publish_to_queues, args, reviews_queue, details_queue
-    )
-    scheduler.run_all()
+    signal.signal(signal.SIGTERM, exit_on_sigterm)
+    # profile the next cycles of a running process: kill -USR1 <pid>
+    signal.signal(signal.SIGUSR1, lambda signum, frame: tracer.request_profile(args.profile_cycles))
+    try:
+        scheduler.run_all()
 
-    while True:
-        scheduler.run_pending()
-        time.sleep(1)
+        while True:
+            scheduler.run_pending()
+            time.sleep(1)
+    finally:
+        if shards is not None:
+            shards.stop()
+        registry.close()
 
 
 if __name__ == '__main__':
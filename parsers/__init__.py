@@ -1,2 +1,4 @@
-from .github import PullRequestUrlParser, PullRequestDataParser
-from .slack import MessagePullRequestUrlParser, MessageReactionsParser
+from .github import PullRequest, PullRequestUrlParser, PullRequestDataParser,\
+    PullRequestReviewState, PullRequestCacheRecord
+from .slack import MessagePullRequestUrlParser, MessageReactionsParser,\
+    MessageWorkItem, parse_work_item
@@ -1,18 +1,39 @@
 import logging
+from typing import NamedTuple
 from urllib.parse import urlparse
+from utils import log_summary
+
+
+class PullRequest(NamedTuple):
+    """ Immutable Pull Request coordinates """
+
+    url: str
+    repo_owner: str
+    repo_name: str
+    number: str
+
+    @property
+    def api_params(self):
+        return {"repo_owner": self.repo_owner, "repo_name": self.repo_name, "number": self.number}
+
+    @property
+    def cache_path(self):
+        return f"repos/{self.repo_owner}/{self.repo_name}/{self.number}"
 
 
 class PullRequestUrlParser:
     """ Pull Request URL Parser """
 
     def __init__(self, pull_request_url):
-        logging.info(f"parsing pull request url {pull_request_url}"
-                     f" using {self.__class__.__name__}")
         self.url = pull_request_url
         self.url_path = urlparse(self.url).path.split("/")
 
         self.api_params = self.api_params_from_url()
         self.cache_path = self.generate_cache_path()
+        self.pull_request = PullRequest(self.url, **self.api_params) if self.api_params else None
+        if self.pull_request is None:
+            log_summary.count("invalid_pull_request_urls")
+            logging.debug("not a pull request url: %s", pull_request_url)
 
     def api_params_from_url(self):
         try:
@@ -34,19 +55,29 @@ class PullRequestDataParser:
 
     def __init__(self, pull_request_data):
         self.data = pull_request_data
-        if self.data:
-            logging.info("parsing pull request data using"
-                         f" {self.__class__.__name__}")
 
     def is_merged(self):
         details = self.data.get("details", {})
         merged = details.get("merged")
         html_url = details.get("html_url")
-        if merged:
-            if html_url:
-                logging.info(f"pull request [{html_url}] is merged")
-                return True
-        logging.info("pull request is not merged")
+        if merged and html_url:
+            log_summary.count("pull_requests_merged")
+            if log_summary.sampled():
+                logging.info("pull request [%s] is merged", html_url)
+            return True
+        log_summary.count("pull_requests_not_merged")
+        if log_summary.sampled():
+            logging.info("pull request [%s] is not merged", html_url)
+        return False
+
+    def is_closed(self):
+        # closed without being merged, the pull request won't change state anymore
+        details = self.data.get("details", {})
+        if details.get("state") == "closed" and not details.get("merged"):
+            log_summary.count("pull_requests_closed")
+            if log_summary.sampled():
+                logging.info("pull request [%s] is closed", details.get("html_url"))
+            return True
         return False
 
     def is_approved(self):
@@ -54,8 +85,82 @@ class PullRequestDataParser:
         states = [review["state"] for review in reviews]
         hrefs = [review["html_url"] for review in reviews]
         if states and states[-1] == "APPROVED":
-            logging.info(f"pull request is approved: {hrefs[-1]}")
+            log_summary.count("pull_requests_approved")
+            if log_summary.sampled():
+                logging.info("pull request is approved: %s", hrefs[-1])
             return True
         else:
-            logging.info(f"pull request is not approved")
+            log_summary.count("pull_requests_not_approved")
+            if log_summary.sampled():
+                logging.info("pull request is not approved")
             return False
+
+
+class PullRequestReviewState:
+    """ Running per-reviewer review state, folded from review pages newest first """
+
+    def __init__(self):
+        self.reviewers = {}
+        self.last_review = None
+
+    @staticmethod
+    def summarize_page(reviews: list):
+        reviewers = {}
+        for review in reviews:
+            # comments don't change the reviewer's decision
+            if review.get("state") != "COMMENTED":
+                reviewers[(review.get("user") or {}).get("login")] = review.get("state")
+        last = {"state": reviews[-1].get("state"), "html_url": reviews[-1].get("html_url")} \
+            if reviews else None
+        return {"count": len(reviews), "reviewers": reviewers, "last": last}
+
+    @property
+    def decided(self):
+        return self.last_review is not None
+
+    def fold_page(self, page_summary: dict):
+        if self.last_review is None:
+            self.last_review = page_summary.get("last")
+        for login, state in page_summary.get("reviewers", {}).items():
+            # newer pages were folded first and hold the latest state
+            self.reviewers.setdefault(login, state)
+
+
+class PullRequestCacheRecord:
+    """ Compact, versioned cache record holding only validators and derived state """
+
+    version = 1
+
+    @staticmethod
+    def compact(pull_request_data: dict):
+        headers = pull_request_data.get("headers", {})
+        record = {
+            "version": PullRequestCacheRecord.version,
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified")
+        }
+        if "details" in pull_request_data:
+            details = pull_request_data["details"]
+            record["details"] = {"merged": details.get("merged"), "state": details.get("state"),
+                                 "html_url": details.get("html_url")}
+        if "reviews" in pull_request_data:
+            record["reviews"] = [{"state": review.get("state"), "html_url": review.get("html_url")}
+                                 for review in pull_request_data["reviews"][-1:]]
+            record["reviewers"] = pull_request_data.get("reviewers", {})
+            record["pages"] = pull_request_data.get("pages", {})
+        return {key: value for key, value in record.items() if value is not None}
+
+    @staticmethod
+    def expand(record: dict):
+        # records written before versioning hold the full API response
+        if "version" not in record:
+            return record
+        data = {"headers": {}}
+        if record.get("etag"):
+            data["headers"]["ETag"] = record["etag"]
+        if record.get("last_modified"):
+            data["headers"]["Last-Modified"] = record["last_modified"]
+        for key in ("details", "reviews", "reviewers", "pages"):
+            if key in record:
+                data[key] = record[key]
+        return data
@@ -1,3 +1,6 @@
+from .github import PullRequest, PullRequestUrlParser
+from utils import log_summary
+from typing import NamedTuple
 import logging
 import re
 
@@ -7,8 +10,6 @@ class MessageElementParser:
 
     def __init__(self, message: dict):
         self.message_timestamp = message.get("ts")
-        logging.info(f"parsing [{self.message_timestamp}] "
-                     f"using {self.__class__.__name__}")
         self.message = message
 
         self.layout_blocks = self.message.get("blocks", [])
@@ -34,9 +35,11 @@ class MessageElementParser:
         for layout_block in self.layout_blocks:
             block_elements = self.get_block_elements(layout_block)
             layout_elements.extend(block_elements)
-        logging.info(f"message [{self.message_timestamp}] contains"
-                     f" {len(layout_elements)} elements")
-        logging.debug(f"message layout elements: {layout_elements}")
+        log_summary.count("messages_parsed")
+        log_summary.count("message_elements", len(layout_elements))
+        if log_summary.sampled():
+            logging.info("message [%s] contains %d elements", self.message_timestamp, len(layout_elements))
+            logging.debug("message layout elements: %s", layout_elements)
         return layout_elements
 
 
@@ -45,8 +48,6 @@ class MessagePullRequestUrlParser(MessageElementParser):
 
     def __init__(self, message: dict):
         super().__init__(message)
-        logging.info(f"parsing [{self.message_timestamp}] "
-                     f"using {self.__class__.__name__}")
 
         self.urls = [message_element.get("url") for message_element in self.elements
                      if message_element.get("type") == "link"]
@@ -57,13 +58,15 @@ class MessagePullRequestUrlParser(MessageElementParser):
         urls = [match.group() for url in self.urls
                 if (match := re.fullmatch(re_pattern, url))]
         if urls:
-            logging.info(f"message [{self.message_timestamp}] "
-                         f"contains {len(urls)} pull request URLs")
-            logging.debug(f"message pr urls: {urls}")
+            log_summary.count("messages_with_pull_requests")
+            log_summary.count("pull_request_urls", len(urls))
+            if log_summary.sampled():
+                logging.info("message [%s] contains %d pull request URLs", self.message_timestamp, len(urls))
+                logging.debug("message pr urls: %s", urls)
             return urls
         else:
-            logging.info(f"message [{self.message_timestamp}] "
-                         f"does not contain any pull requests")
+            if log_summary.sampled():
+                logging.info("message [%s] does not contain any pull requests", self.message_timestamp)
             return []
 
 
@@ -72,8 +75,6 @@ class MessageReactionsParser:
 
     def __init__(self, message: dict):
         self.message_timestamp = message.get("ts")
-        logging.info(f"parsing [{self.message_timestamp}] "
-                     f"using {self.__class__.__name__}")
         self.message = message
         self.reactions = self.get_message_reactions()
 
@@ -82,22 +83,60 @@ class MessageReactionsParser:
         reaction_names = [reaction.get("name") for reaction in reactions]
         reactions_count = len(reaction_names)
 
+        log_summary.count("message_reactions", reactions_count)
+        if not log_summary.sampled():
+            return reaction_names
         if reactions_count > 0:
-            logging.info(f"message [{self.message_timestamp}] "
-                         f"contains {reactions_count} reactions")
-            logging.debug(f"message reactions: {reaction_names}")
+            logging.info("message [%s] contains %d reactions", self.message_timestamp, reactions_count)
+            logging.debug("message reactions: %s", reaction_names)
         else:
-            logging.info(f"message [{self.message_timestamp}]"
-                         f" has no user reactions")
+            logging.info("message [%s] has no user reactions", self.message_timestamp)
 
         return reaction_names
 
     def lookup_reaction(self, reaction):
-        if reaction in self.reactions:
-            logging.info(f"message [{self.message_timestamp}]: "
-                         f"reaction {reaction} was found")
-            return True
-        else:
-            logging.info(f"message [{self.message_timestamp}]: "
-                         f"reaction {reaction} was not found")
-            return False
+        found = reaction in self.reactions
+        if log_summary.sampled():
+            logging.info("message [%s]: reaction %s was %s", self.message_timestamp, reaction,
+                         "found" if found else "not found")
+        return found
+
+
+class MessageWorkItem(NamedTuple):
+    """ Slack message parsed once and shared by all processors """
+
+    ts: str
+    pull_requests: tuple
+    reactions: frozenset
+    channel: str = ""
+
+    def lookup_reaction(self, reaction: str):
+        return reaction in self.reactions
+
+    def with_reactions(self, reactions):
+        if not reactions or reactions <= self.reactions:
+            return self
+        return self._replace(reactions=self.reactions | frozenset(reactions))
+
+    def to_dict(self):
+        return {
+            "ts": self.ts,
+            "pull_requests": [list(pull_request) for pull_request in self.pull_requests],
+            "reactions": sorted(self.reactions),
+            "channel": self.channel
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(data["ts"],
+                   tuple(PullRequest(*pull_request) for pull_request in data["pull_requests"]),
+                   frozenset(data["reactions"]),
+                   data.get("channel", ""))
+
+
+def parse_work_item(message: dict, channel: str = ""):
+    url_parser = MessagePullRequestUrlParser(message)
+    pull_requests = tuple(url.pull_request for url in map(PullRequestUrlParser, url_parser.pull_requests)
+                          if url.pull_request)
+    reactions = MessageReactionsParser(message).reactions if pull_requests else []
+    return MessageWorkItem(message["ts"], pull_requests, frozenset(reactions), channel)
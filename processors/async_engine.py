@@ -0,0 +1,189 @@
+from .pr_details import PullRequestDetails
+from .pr_reviews import PullRequestReview
+from .helpers import get_cached_data, save_cached_data, get_request_headers,\
+    evict_cached_data
+from parsers import PullRequest, MessageWorkItem, parse_work_item
+
+from clients import CacheClient, ReactionIndex, metrics
+from clients.async_github import AsyncGitHubClient
+from clients.tracing import tracer
+from clients.async_slack import AsyncSlackClient
+from clients.github import GitNotModified
+from clients.slack import set_oldest_ts, has_replies
+from slack_sdk.errors import SlackApiError
+from utils import SlackChannel, log_summary
+
+import aiohttp
+import argparse
+import asyncio
+import logging
+import time
+
+
+class AsyncEngine:
+    """ asyncio runtime running a whole cycle of lookups concurrently """
+
+    def __init__(self, args_config: argparse.Namespace, cache_client: CacheClient,
+                 reaction_index: ReactionIndex, thread_caches: dict):
+        self.config = args_config
+        self.cache_client = cache_client
+        self.reaction_index = reaction_index
+        self.thread_caches = thread_caches  # channel id -> ThreadCache
+
+        self.slack_client = None
+        self.git_client = None
+        self.semaphore = None
+        self.lookups = {}
+        self.saved_calls = 0
+
+    @tracer.cycle()
+    def publish(self):
+        cycle_started = time.monotonic()
+        asyncio.run(self.run_cycle())
+        cycle_duration = time.monotonic() - cycle_started
+        metrics.cycle_duration.observe(cycle_duration)
+        logging.info(f"cycle completed in {cycle_duration:.1f}s")
+        log_summary.flush()
+
+    async def run_cycle(self):
+        self.slack_client = AsyncSlackClient(api_token=self.config.slack_api_token,
+                                             max_retries=self.config.max_client_retries,
+                                             api_url=self.config.slack_api_url)
+        self.semaphore = asyncio.Semaphore(self.config.async_concurrency)
+        self.lookups = {}
+        self.saved_calls = 0
+
+        async with AsyncGitHubClient(api_token=self.config.github_api_token,
+                                     api_host=self.config.github_api_host,
+                                     max_retries=self.config.max_client_retries,
+                                     connections=self.config.async_concurrency) as git_client:
+            self.git_client = git_client
+            items = await self.generate_work_items()
+            await asyncio.gather(*(self.process_item(item) for item in items))
+
+        logging.info(f"github lookups saved by request coalescing: {self.saved_calls}")
+        referenced = {pull_request.cache_path for item in items for pull_request in item.pull_requests}
+        await self.run_blocking(evict_cached_data, self.config, self.cache_client, referenced)
+
+    async def expand_message(self, channel: SlackChannel, message: dict):
+        message_ts = message["ts"]
+        items = [parse_work_item(message, channel.channel_id)]
+        latest_reply = message.get("latest_reply")
+        thread_cache = self.thread_caches[channel.channel_id]
+        replies = thread_cache.get_replies(message_ts, latest_reply)
+        if replies is None:
+            async with self.semaphore:
+                messages = await self.slack_client.get_conversation_replies(
+                    channel.channel_id, channel.time_window_minutes, message_ts)
+            replies = tuple(item for item in (parse_work_item(reply, channel.channel_id) for reply in messages)
+                            if item.ts != message_ts and item.pull_requests)
+            thread_cache.set_replies(message_ts, latest_reply, replies)
+        return items + list(replies)
+
+    async def generate_channel_items(self, channel: SlackChannel):
+        self.thread_caches[channel.channel_id].expire(set_oldest_ts(channel.time_window_minutes))
+        messages = await self.slack_client.get_conversation_history(
+            channel.channel_id, channel.time_window_minutes)
+        items = [parse_work_item(message, channel.channel_id)
+                 for message in messages if not has_replies(message)]
+        threads = await asyncio.gather(*(self.expand_message(channel, message) for message in messages
+                                         if has_replies(message)))
+        for thread_items in threads:
+            items.extend(thread_items)
+        return items
+
+    async def generate_work_items(self):
+        channels = self.config.slack_channels.values()
+        self.reaction_index.expire(set_oldest_ts(max(channel.time_window_minutes for channel in channels)))
+
+        channel_items = await asyncio.gather(*(self.generate_channel_items(channel) for channel in channels))
+        return [item.with_reactions(self.reaction_index.get(item.channel, item.ts))
+                for items in channel_items for item in items if item.pull_requests]
+
+    async def process_item(self, item: MessageWorkItem):
+        channel = self.config.slack_channels[item.channel]
+        # skip processing these messages (usually caused by no access to repos).
+        if item.lookup_reaction(channel.github_error_reaction_name):
+            return
+        kinds = []
+        if not item.lookup_reaction(channel.approved_reaction_name):
+            kinds.append(("reviews", channel.approved_reaction_name))
+        if not item.lookup_reaction(channel.merged_reaction_name):
+            kinds.append(("details", channel.merged_reaction_name))
+        await asyncio.gather(*(self.process_message(item, kind, reaction) for kind, reaction in kinds))
+
+    async def run_blocking(self, func, *args):
+        # cache reads and writes block, they run on the default executor instead of the event loop
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def process_message(self, item: MessageWorkItem, kind: str, reaction: str):
+        # failures are contained per message, as in the threaded processors
+        try:
+            states = await asyncio.gather(*(self.process_pull_request(item, pull_request, kind)
+                                            for pull_request in item.pull_requests))
+            if states and all(states):
+                await self.add_reaction(item, reaction)
+                for pull_request in item.pull_requests:
+                    await self.run_blocking(self.cache_client.clean_up_cached_dir,
+                                            f"{pull_request.cache_path}/{kind}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            logging.warning(f"client exception: {err!r}")
+        except SlackApiError as err:
+            logging.warning(f"slack client exception: {err}")
+
+    async def process_pull_request(self, item: MessageWorkItem, pull_request: PullRequest, kind: str):
+        cache_folder = f"{pull_request.cache_path}/{kind}"
+        # lookups of the same pull request are shared within a cycle
+        if cache_folder in self.lookups:
+            self.saved_calls += 1
+        else:
+            self.lookups[cache_folder] = asyncio.ensure_future(
+                self.get_url_data(pull_request, kind, cache_folder))
+        url_data, state = await self.lookups[cache_folder]
+
+        if url_data is None:
+            # Indicate that fetching data failed by adding an error reaction
+            await self.add_reaction(item, self.config.slack_channels[item.channel].github_error_reaction_name)
+            # Clean up and stop processing
+            await self.run_blocking(self.cache_client.clean_up_cached_dir, cache_folder)
+            return False
+        return state
+
+    async def get_url_data(self, pull_request: PullRequest, kind: str, cache_folder: str):
+        is_done = PullRequestReview.is_approved if kind == "reviews" else PullRequestDetails.is_merged
+        cached_data = await self.run_blocking(get_cached_data, self.cache_client, cache_folder)
+        if cached_data and is_done(cached_data):
+            return cached_data, True
+
+        api_params = pull_request.api_params
+        if kind == "reviews":
+            fetch = self.git_client.get_pull_request_reviews
+            if cached_data:
+                api_params["pages"] = cached_data.get("pages")
+        else:
+            fetch = self.git_client.get_pull_request
+            if cached_data:
+                entity_tag, last_modified = get_request_headers(cached_data)
+                api_params.update({"entity_tag": entity_tag, "last_modified": last_modified})
+        try:
+            async with self.semaphore:
+                data = await fetch(**api_params)
+        except GitNotModified as err:
+            log_summary.count("pull_requests_not_modified")
+            if log_summary.sampled():
+                logging.info(err)
+            data = cached_data
+        except aiohttp.ClientResponseError as err:
+            logging.warning(f"github client error: {err}")
+            data = None
+
+        if data:
+            await self.run_blocking(save_cached_data, self.cache_client, cache_folder, data)
+        return data, is_done(data)
+
+    async def add_reaction(self, item: MessageWorkItem, reaction: str):
+        async with self.semaphore:
+            reacted = await self.slack_client.add_message_reaction(
+                item.channel, reaction, item.ts, self.config.dry_run)
+        if reacted and not self.config.dry_run:
+            self.reaction_index.add(item.channel, item.ts, reaction)
@@ -1,36 +1,29 @@
-from parsers import MessagePullRequestUrlParser,\
-    PullRequestUrlParser, MessageReactionsParser
 from clients import NoCachedData, CacheClient
+from parsers import PullRequestCacheRecord
+from utils import log_summary
 
+import argparse
 import logging
 
 
-def get_pull_request_urls(message):
-    parser = MessagePullRequestUrlParser(message)
-    if parser.pull_requests:
-        return [PullRequestUrlParser(pr)
-                for pr in parser.pull_requests]
-    return None
-
-
-def lookup_reaction(message, reaction):
-    parser = MessageReactionsParser(message)
-    if parser.reactions:
-        return parser.lookup_reaction(reaction)
-    return False
-
-
 def get_cached_data(local_client: CacheClient, cache_path: str,
                     file_name: str = None):
     file_name = file_name if file_name else "data.json"
     try:
-        cached_data = local_client.load_data_from_file(
+        cached_record = local_client.load_data_from_file(
             cache_path, file_name)
-        return cached_data
+        return PullRequestCacheRecord.expand(cached_record)
     except NoCachedData:
         return None
 
 
+def save_cached_data(local_client: CacheClient, cache_path: str, data: dict,
+                     file_name: str = None):
+    file_name = file_name if file_name else "data.json"
+    local_client.save_data_to_file(
+        PullRequestCacheRecord.compact(data), cache_path, file_name)
+
+
 def get_request_headers(cache_data: dict):
     headers = cache_data.get("headers", {})
 
@@ -38,12 +31,24 @@ def get_request_headers(cache_data: dict):
     last_modified = headers.get("Last-Modified")
 
     if entity_tag and not last_modified:
-        logging.info(f"Using cached ETag header: {entity_tag}")
+        if log_summary.sampled():
+            logging.info("Using cached ETag header: %s", entity_tag)
         return entity_tag, None
 
     if entity_tag and last_modified:
-        logging.info(f"Using cached Last-Modified header: {last_modified}")
+        if log_summary.sampled():
+            logging.info("Using cached Last-Modified header: %s", last_modified)
         return None, last_modified
 
     logging.warning("No cached headers to use")
     return None, None
+
+
+def evict_cached_data(config: argparse.Namespace, local_client: CacheClient, referenced: set):
+    stats = local_client.evict(referenced,
+                               ttl_seconds=config.cache_ttl_hours * 3600,
+                               max_size_bytes=config.cache_max_size_mb * 1024 * 1024)
+    logging.info(f"cache eviction: {stats['unreferenced']} unreferenced, {stats['expired']} expired, "
+                 f"{stats['over_size_cap']} over size cap; "
+                 f"{stats['entries']} entries ({stats['size_bytes']} bytes) left")
+    return stats
@@ -1,9 +1,10 @@
 from .processors import ProcessorBase
-from .helpers import get_pull_request_urls,\
-    get_cached_data, get_request_headers
-from parsers import PullRequestUrlParser, PullRequestDataParser
+from .helpers import get_cached_data
+from parsers import PullRequest, PullRequestDataParser, MessageWorkItem
 
-from clients.github import GitNotModified
+from clients import ReactionIndex, ClientRegistry, PollSchedule, ShardCoordinator
+from clients.github import GitNotModified, GitRateLimitDeferred
+from utils import RequestCoalescer, SlackChannel, log_summary
 from requests.exceptions import RequestException, HTTPError
 from slack_sdk.errors import SlackApiError
 
@@ -13,30 +14,38 @@ import queue
 
 
 class PullRequestReview(ProcessorBase):
-    def __init__(self, args_config: argparse.Namespace, source_queue: queue.Queue):
-        super().__init__(args_config)
+    def __init__(self, args_config: argparse.Namespace, source_queue: queue.Queue,
+                 registry: ClientRegistry = None, coalescer: RequestCoalescer = None,
+                 reaction_index: ReactionIndex = None, poll_schedule: PollSchedule = None,
+                 shards: ShardCoordinator = None):
+        super().__init__(args_config, registry, coalescer, reaction_index, poll_schedule, shards)
 
         self.source_queue = source_queue
         self.name = "PrReviewProcessor"
-        self.reaction = self.config.slack_approved_reaction_name
 
-    def get_url_data(self, url: PullRequestUrlParser, cache_path: str):
+    def get_reaction(self, channel: SlackChannel):
+        return channel.approved_reaction_name
+
+    def get_state(self, url_data: dict):
+        return PullRequestReview.is_approved(url_data)
+
+    def get_url_data(self, pull_request: PullRequest, cache_path: str):
         cached_data = get_cached_data(self.cache_client, cache_path)
 
         is_approved = PullRequestReview.is_approved(cached_data)
         if cached_data and is_approved:
             return cached_data, is_approved
 
+        api_params = pull_request.api_params
         if cached_data and not is_approved:
-            entity_tag, last_modified = get_request_headers(cached_data)
-            url.api_params.update({
-                "entity_tag": entity_tag,
-                "last_modified": last_modified
-            })
+            # review pages are validated one by one with their own ETags
+            api_params["pages"] = cached_data.get("pages")
         try:
-            data = self.git_client.get_pull_request_reviews(**url.api_params)
+            data = self.git_client.get_pull_request_reviews(**api_params)
         except GitNotModified as err:
-            logging.info(err)
+            log_summary.count("pull_requests_not_modified")
+            if log_summary.sampled():
+                logging.info(err)
             data = cached_data
         except HTTPError as err:
             logging.warning(f"github client error: {err}")
@@ -47,34 +56,45 @@ class PullRequestReview(ProcessorBase):
 
     def run(self):
         while True:
-            message = self.source_queue.get()
-            pull_request_states = []
-            pull_request_caches = []
+            item = self.source_queue.get()
             try:
-                pull_request_urls = get_pull_request_urls(message)
-                for url in pull_request_urls:
-
-                    cache_folder = f"{url.cache_path}/reviews"
-                    state = self.process_pull_request(self.get_url_data,
-                                                      url, cache_folder,
-                                                      message)
-                    pull_request_states.append(state)
-                    pull_request_caches.append(cache_folder)
-
-            except RequestException as err:
-                logging.warning(f"github client exception: {err}")
-                pass
-            except SlackApiError as err:
-                logging.warning(f"slack client exception: {err}")
-                pass
-
-            if pull_request_states and all(pull_request_states):
-                self.add_reaction(message["ts"], self.reaction)
-
-                for cache_path in pull_request_caches:
-                    self.cache_client.clean_up_cached_dir(cache_path)
-
-            self.source_queue.task_done()
+                self.process_item(item)
+            except Exception:
+                # the worker keeps going, publish_to_queues waits for every queued item
+                logging.exception(f"unexpected exception processing message {item.ts}")
+            finally:
+                self.source_queue.task_done()
+
+    def process_item(self, item: MessageWorkItem):
+        pull_request_states = []
+        pull_request_caches = []
+        try:
+            for pull_request in item.pull_requests:
+
+                cache_folder = f"{pull_request.cache_path}/reviews"
+                state = self.process_pull_request(self.get_url_data,
+                                                  pull_request, cache_folder,
+                                                  item)
+                pull_request_states.append(state)
+                pull_request_caches.append(cache_folder)
+
+        except GitRateLimitDeferred as err:
+            logging.info(err)
+            # checked again next cycle
+            pull_request_states.append(False)
+        except RequestException as err:
+            logging.warning(f"github client exception: {err}")
+            # pull requests left unresolved must not count as done
+            pull_request_states.append(False)
+        except SlackApiError as err:
+            logging.warning(f"slack client exception: {err}")
+            pass
+
+        if pull_request_states and all(pull_request_states):
+            self.add_reaction(item, self.get_reaction(self.channel(item)))
+
+            for cache_path in pull_request_caches:
+                self.cache_client.clean_up_cached_dir(cache_path)
 
     @staticmethod
     def is_approved(pull_request_data: dict):
@@ -1,54 +1,107 @@
 from clients import *
 from parsers import *
+from .helpers import get_cached_data, save_cached_data
+from clients.slack import set_oldest_ts
+from clients.tracing import tracer
 from threading import Thread
+from utils import RequestCoalescer, SlackChannel
 import argparse
+import logging
 
 from slack_sdk.errors import SlackApiError
 
 
 class ProcessorBase(Thread):
-    def __init__(self, args_config: argparse.Namespace):
+    def __init__(self, args_config: argparse.Namespace, registry: ClientRegistry = None,
+                 coalescer: RequestCoalescer = None, reaction_index: ReactionIndex = None,
+                 poll_schedule: PollSchedule = None, shards: ShardCoordinator = None):
         super().__init__()
 
         self.daemon = True
         self.config = args_config
+        # lookups of the same pull request are shared within a cycle
+        self.coalescer = coalescer if coalescer else RequestCoalescer()
+        # reactions added here are seen by the producer without re-fetching messages
+        self.reaction_index = reaction_index if reaction_index else ReactionIndex()
+        # quiet pull requests are polled less often (every cycle when not set)
+        self.poll_schedule = poll_schedule
+        # replicas only react to messages of the shards they hold
+        self.shards = shards
 
-        self.git_client = GitHubClient(
-            api_token=args_config.github_api_token,
-            max_retries=args_config.max_client_retries
-        )
-        self.slack_client = SlackClient(
-            api_token=args_config.slack_api_token,
-            max_retries=args_config.max_client_retries
-        )
-        self.cache_client = CacheClient(
-            local_dir_path=args_config.cache_folder_path
-        )
-
-        self.reaction_err = self.config.slack_github_error_reaction_name
-
-    def process_pull_request(self, func_to_run, url: PullRequestUrlParser,
-                             cache_folder: str, message: dict):
-        url_data, state = func_to_run(url, cache_folder)
+        # clients (and their connection pools) are shared by all threads of the process
+        registry = registry if registry else ClientRegistry(args_config)
+        self.git_client = registry.git_client
+        self.slack_client = registry.slack_client
+        self.cache_client = registry.cache_client
+
+    def fetch_pull_request(self, func_to_run, pull_request: PullRequest, cache_folder: str):
+        cached_data = get_cached_data(self.cache_client, cache_folder)
+        if self.poll_schedule is not None and cached_data \
+                and not self.poll_schedule.is_due(cache_folder):
+            # merged or approved pull requests still count as done while they're not polled
+            return cached_data, self.get_state(cached_data)
+
+        url_data, state = func_to_run(pull_request, cache_folder)
         if url_data:
-            self.cache_client.save_data_to_file(url_data, cache_folder)
+            save_cached_data(self.cache_client, cache_folder, url_data)
+            if self.poll_schedule is not None:
+                self.schedule_next_poll(pull_request, cache_folder, cached_data, url_data)
+        return url_data, state
+
+    def schedule_next_poll(self, pull_request: PullRequest, cache_folder: str,
+                           cached_data: dict, url_data: dict):
+        # not modified responses leave the compact record as it was
+        changed = cached_data is None or \
+            PullRequestCacheRecord.compact(url_data) != PullRequestCacheRecord.compact(cached_data)
+        self.poll_schedule.polled(cache_folder, changed)
+        if PullRequestDataParser(url_data).is_closed():
+            self.poll_schedule.retire(pull_request.cache_path)
+
+    @tracer.profiled()
+    def process_pull_request(self, func_to_run, pull_request: PullRequest,
+                             cache_folder: str, item: MessageWorkItem):
+        if self.poll_schedule is not None and self.poll_schedule.is_retired(pull_request.cache_path):
+            return False
+        # lookups for older messages are deferred first when the API quota runs low
+        with self.git_client.budget.prioritize(self.is_high_priority(item)):
+            url_data, state = self.coalescer.run(cache_folder, self.fetch_pull_request,
+                                                 func_to_run, pull_request, cache_folder)
         if url_data is None:
             # Indicate that fetching data failed by adding an error reaction
-            self.add_reaction(message["ts"], self.reaction_err)
+            self.add_reaction(item, self.channel(item).github_error_reaction_name)
             # Clean up and stop processing
             self.cache_client.clean_up_cached_dir(cache_folder)
             return False
         return state
 
-    def add_reaction(self, message_ts: str, reaction: str):
+    def channel(self, item: MessageWorkItem) -> SlackChannel:
+        return self.config.slack_channels[item.channel]
+
+    def get_reaction(self, channel: SlackChannel):
+        pass
+
+    def get_state(self, url_data: dict):
+        pass
+
+    def is_high_priority(self, item: MessageWorkItem):
+        # messages in the newer half of the channel's time window
+        time_window = self.channel(item).time_window_minutes
+        return float(item.ts) >= float(set_oldest_ts(time_window / 2))
+
+    @tracer.profiled()
+    def add_reaction(self, item: MessageWorkItem, reaction: str):
+        if self.shards is not None and not self.shards.owns(item):
+            logging.info(f"message [{item.ts}] moved to another replica, not reacting")
+            return
         try:
-            self.slack_client.add_message_reaction(
-                self.config.slack_channel_id,
-                reaction, message_ts,
+            reacted = self.slack_client.add_message_reaction(
+                item.channel,
+                reaction, item.ts,
                 self.config.dry_run)
         except SlackApiError as e:
-            if e.response["error"] == "already_reacted":
-                pass
+            reacted = e.response["error"] == "already_reacted"
+        if reacted and not self.config.dry_run:
+            self.reaction_index.add(item.channel, item.ts, reaction)
 
     def run(self):
         pass
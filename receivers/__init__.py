@@ -0,0 +1,2 @@
+from .github import GitHubWebhookReceiver
+from .slack import SlackEventsReceiver
@@ -0,0 +1,149 @@
+"""
+Embedded endpoint receiving signed GitHub `pull_request` and `pull_request_review`
+webhook events, so merges and approvals are reacted to without waiting for a poll:
+
+    python main.py --github_webhook_port 8082 --github_webhook_secret <secret> ...
+
+Configure the repository (or organization) webhook to send JSON payloads
+of these two events to http://<host>:8082/github.
+"""
+from clients import ClientRegistry, ReactionIndex, PollSchedule, PullRequestIndex
+from parsers import PullRequest
+from processors.helpers import get_cached_data, save_cached_data
+from utils import RequestCoalescer
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+import argparse
+import hashlib
+import logging
+import queue
+import hmac
+import json
+
+
+def verify_signature(secret: str, body: bytes, signature: str):
+    if not secret or not signature:
+        return False
+    digest = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(f"sha256={digest}", signature)
+
+
+class GitHubWebhookHandler(BaseHTTPRequestHandler):
+    """ Verifies and dispatches webhook deliveries to the receiver """
+
+    receiver = None
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/github":
+            self.send_error(404)
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        if not verify_signature(self.receiver.secret, body, self.headers.get("X-Hub-Signature-256")):
+            logging.warning("rejected github webhook delivery with an invalid signature")
+            self.send_error(401)
+            return
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            self.send_error(400)
+            return
+        event = self.headers.get("X-GitHub-Event")
+        logging.info(f"received github webhook event {event} "
+                     f"({self.headers.get('X-GitHub-Delivery')})")
+        handled = self.receiver.handle_event(event, payload)
+        self.send_response(202 if handled else 204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logging.debug(f"github webhooks: {format % args}")
+
+
+class GitHubWebhookReceiver:
+    """ Applies pull request webhook events to the cache and queues affected messages """
+
+    def __init__(self, args_config: argparse.Namespace, registry: ClientRegistry,
+                 reviews_queue: queue.Queue, details_queue: queue.Queue,
+                 coalescer: RequestCoalescer, reaction_index: ReactionIndex,
+                 pull_request_index: PullRequestIndex, poll_schedule: PollSchedule = None):
+        self.config = args_config
+        self.secret = args_config.github_webhook_secret
+        self.cache_client = registry.cache_client
+        self.queues = {"reviews": reviews_queue, "details": details_queue}
+        self.coalescer = coalescer
+        self.reaction_index = reaction_index
+        self.pull_request_index = pull_request_index
+        self.poll_schedule = poll_schedule
+        self.server = None
+
+    @staticmethod
+    def parse_pull_request(payload: dict):
+        details = payload.get("pull_request") or {}
+        repository = payload.get("repository") or {}
+        owner = (repository.get("owner") or {}).get("login")
+        if details.get("number") is None or not owner or not repository.get("name"):
+            return None
+        return PullRequest(details.get("html_url"), owner,
+                           repository["name"], str(details["number"]))
+
+    def handle_event(self, event: str, payload: dict):
+        # other events (e.g. ping, or ones added to the hook later) don't carry a pull request
+        pull_request = self.parse_pull_request(payload) if isinstance(payload, dict) else None
+        if pull_request is None:
+            logging.debug(f"ignoring github webhook event {event} without a pull request")
+            return False
+        if event == "pull_request":
+            kind = "details"
+            data = self.apply_details(pull_request, payload["pull_request"])
+        elif event == "pull_request_review" and payload.get("action") == "submitted" \
+                and isinstance(payload.get("review"), dict):
+            kind = "reviews"
+            data = self.apply_review(pull_request, payload["review"])
+        else:
+            logging.debug(f"ignoring github webhook event {event}")
+            return False
+
+        cache_folder = f"{pull_request.cache_path}/{kind}"
+        save_cached_data(self.cache_client, cache_folder, data)
+        self.coalescer.forget(cache_folder)
+        if self.poll_schedule is not None:
+            self.poll_schedule.wake(pull_request.cache_path)
+            if payload.get("action") == "closed" and not payload["pull_request"].get("merged"):
+                self.poll_schedule.retire(pull_request.cache_path)
+
+        queued = 0
+        for item in self.pull_request_index.get(pull_request.cache_path):
+            # the same pull request may be referenced from several channels
+            channel = self.config.slack_channels[item.channel]
+            reaction = channel.approved_reaction_name if kind == "reviews" else channel.merged_reaction_name
+            item = item.with_reactions(self.reaction_index.get(item.channel, item.ts))
+            if not item.lookup_reaction(reaction):
+                self.queues[kind].put(item)
+                queued += 1
+        logging.info(f"github webhook for {pull_request.cache_path} queued {queued} messages")
+        return True
+
+    def apply_details(self, pull_request: PullRequest, details: dict):
+        # webhook payloads carry the same pull request object as the REST API,
+        # cached validators are kept as the webhook state is at least as recent
+        data = get_cached_data(self.cache_client, f"{pull_request.cache_path}/details") or {"headers": {}}
+        data["details"] = details
+        return data
+
+    def apply_review(self, pull_request: PullRequest, review: dict):
+        # keep review pages, so later polls are still validated with their ETags
+        data = get_cached_data(self.cache_client, f"{pull_request.cache_path}/reviews") or {"headers": {}}
+        state = (review.get("state") or "").upper()
+        login = (review.get("user") or {}).get("login")
+        data["reviews"] = [{"state": state, "html_url": review.get("html_url")}]
+        if state != "COMMENTED":
+            data["reviewers"] = {**data.get("reviewers", {}), login: state}
+        return data
+
+    def start(self):
+        GitHubWebhookHandler.receiver = self
+        self.server = ThreadingHTTPServer(("0.0.0.0", self.config.github_webhook_port), GitHubWebhookHandler)
+        Thread(target=self.server.serve_forever, name="GitHubWebhooks", daemon=True).start()
+        logging.info(f"receiving github webhooks on port {self.config.github_webhook_port}")
@@ -0,0 +1,70 @@
+"""
+Signs and POSTs recorded webhook / event payloads to a locally running receiver:
+
+    python -m receivers.replay --secret <secret> --event pull_request ./merged.json
+    python -m receivers.replay --url http://localhost:8082/github --event pull_request_review ./approved.json
+    python -m receivers.replay --source slack --secret <signing secret> ./message.json ./reaction_added.json
+"""
+from urllib.request import Request, urlopen
+import argparse
+import hashlib
+import hmac
+import time
+import uuid
+
+
+default_urls = {
+    "github": "http://localhost:8082/github",
+    "slack": "http://localhost:8083/slack/events"
+}
+
+
+def sign(secret: str, body: bytes):
+    return hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+def post(url: str, body: bytes, headers: dict):
+    request = Request(url, data=body, method="POST",
+                      headers={"Content-Type": "application/json", **headers})
+    with urlopen(request) as response:
+        return response.status
+
+
+def replay_github(url: str, secret: str, event: str, body: bytes):
+    return post(url, body, {
+        "X-GitHub-Event": event,
+        "X-GitHub-Delivery": str(uuid.uuid4()),
+        "X-Hub-Signature-256": f"sha256={sign(secret, body)}"
+    })
+
+
+def replay_slack(url: str, secret: str, body: bytes):
+    # recorded payloads are signed again with the current time
+    timestamp = str(int(time.time()))
+    return post(url, body, {
+        "X-Slack-Request-Timestamp": timestamp,
+        "X-Slack-Signature": f"v0={sign(secret, b'v0:' + timestamp.encode() + b':' + body)}"
+    })
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source", type=str, choices=["github", "slack"], default="github")
+    parser.add_argument("--url", type=str, required=False)
+    parser.add_argument("--secret", type=str, required=True)
+    parser.add_argument("--event", type=str, required=False,
+                        choices=["pull_request", "pull_request_review", "ping"])
+    parser.add_argument("payload_files", nargs="+")
+    args = parser.parse_args()
+    if args.source == "github" and not args.event:
+        parser.error("--event is required to replay github webhooks")
+
+    url = args.url if args.url else default_urls[args.source]
+    for payload_file in args.payload_files:
+        with open(payload_file, "rb") as file:
+            body = file.read()
+        if args.source == "github":
+            status = replay_github(url, args.secret, args.event, body)
+        else:
+            status = replay_slack(url, args.secret, body)
+        print(f"{payload_file}: {status}")
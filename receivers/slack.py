@@ -0,0 +1,137 @@
+"""
+Embedded Slack Events API endpoint, so new pull request messages are checked
+as soon as they are posted and reactions are known without re-scanning history:
+
+    python main.py --slack_events_port 8083 --slack_signing_secret <secret> ...
+
+Subscribe the Slack app to `message.channels` (or `message.groups`), `reaction_added`
+and `reaction_removed` bot events with http://<host>:8083/slack/events as request URL.
+"""
+from clients import ClientRegistry, ReactionIndex, PullRequestIndex, ShardCoordinator
+from parsers import parse_work_item
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+import argparse
+import hashlib
+import logging
+import queue
+import hmac
+import json
+import time
+
+
+def verify_signature(secret: str, body: bytes, timestamp: str, signature: str):
+    if not secret or not timestamp or not signature:
+        return False
+    try:
+        request_time = int(timestamp)
+    except ValueError:
+        return False
+    # requests older than five minutes may be replayed by someone else
+    if abs(time.time() - request_time) > 60 * 5:
+        return False
+    base = b"v0:" + timestamp.encode() + b":" + body
+    digest = hmac.new(secret.encode(), base, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(f"v0={digest}", signature)
+
+
+class SlackEventsHandler(BaseHTTPRequestHandler):
+    """ Verifies and dispatches Events API requests to the receiver """
+
+    receiver = None
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/slack/events":
+            self.send_error(404)
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        if not verify_signature(self.receiver.secret, body,
+                                self.headers.get("X-Slack-Request-Timestamp"),
+                                self.headers.get("X-Slack-Signature")):
+            logging.warning("rejected slack events request with an invalid signature")
+            self.send_error(401)
+            return
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            self.send_error(400)
+            return
+
+        response = b""
+        if payload.get("type") == "url_verification":
+            response = json.dumps({"challenge": payload.get("challenge")}).encode()
+        elif payload.get("type") == "event_callback":
+            self.receiver.handle_event(payload.get("event", {}))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        logging.debug(f"slack events: {format % args}")
+
+
+class SlackEventsReceiver:
+    """ Queues new pull request messages and tracks reactions from Slack events """
+
+    def __init__(self, args_config: argparse.Namespace, registry: ClientRegistry,
+                 reviews_queue: queue.Queue, details_queue: queue.Queue,
+                 reaction_index: ReactionIndex, pull_request_index: PullRequestIndex = None,
+                 shards: ShardCoordinator = None):
+        self.config = args_config
+        self.secret = args_config.slack_signing_secret
+        self.graphql_client = registry.graphql_client
+        self.reviews_queue = reviews_queue
+        self.details_queue = details_queue
+        self.reaction_index = reaction_index
+        self.pull_request_index = pull_request_index
+        self.shards = shards
+        self.server = None
+
+    def handle_event(self, event: dict):
+        event_type = event.get("type")
+        if event_type == "message":
+            self.handle_message(event)
+        elif event_type in ("reaction_added", "reaction_removed"):
+            self.handle_reaction(event)
+        else:
+            logging.debug(f"ignoring slack event {event_type}")
+
+    def handle_message(self, event: dict):
+        # edits, deletions and other subtypes are picked up by the history scan
+        channel = self.config.slack_channels.get(event.get("channel"))
+        if channel is None or event.get("subtype"):
+            return
+        item = parse_work_item(event, channel.channel_id)
+        if not item.pull_requests or (self.shards is not None and not self.shards.owns(item)):
+            return
+        item = item.with_reactions(self.reaction_index.get(item.channel, item.ts))
+        if self.pull_request_index is not None:
+            self.pull_request_index.add(item)
+        if self.graphql_client is not None:
+            self.graphql_client.announce(item.pull_requests)
+
+        logging.info(f"slack event: new message [{item.ts}] with {len(item.pull_requests)} pull requests")
+        if not item.lookup_reaction(channel.approved_reaction_name):
+            self.reviews_queue.put(item)
+        if not item.lookup_reaction(channel.merged_reaction_name):
+            self.details_queue.put(item)
+
+    def handle_reaction(self, event: dict):
+        message = event.get("item", {})
+        if message.get("type") != "message" or message.get("channel") not in self.config.slack_channels:
+            return
+        logging.info(f"slack event: {event['type']} {event.get('reaction')} on [{message.get('ts')}]")
+        if event["type"] == "reaction_added":
+            self.reaction_index.add(message.get("channel"), message.get("ts"), event.get("reaction"))
+        else:
+            self.reaction_index.remove(message.get("channel"), message.get("ts"), event.get("reaction"))
+
+    def start(self):
+        SlackEventsHandler.receiver = self
+        self.server = ThreadingHTTPServer(("0.0.0.0", self.config.slack_events_port), SlackEventsHandler)
+        Thread(target=self.server.serve_forever, name="SlackEvents", daemon=True).start()
+        logging.info(f"receiving slack events on port {self.config.slack_events_port}")
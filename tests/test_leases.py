@@ -0,0 +1,106 @@
+"""
+Shard leases shared by replicas, each replica runs in its own process:
+
+    python -m pytest tests
+"""
+from clients.leases import ShardCoordinator, lease_backends
+
+import multiprocessing
+import pytest
+import time
+import os
+
+backends = sorted(lease_backends)
+context = multiprocessing.get_context("spawn")
+
+
+def race_for_lease(lease_path: str, backend: str, owner: str, barrier, results):
+    store = lease_backends[backend](lease_path)
+    barrier.wait()
+    results.put((owner, store.acquire("shard/0", owner, 60)))
+
+
+def run_replica(lease_path: str, backend: str, owner: str, shard_count: int, rounds: int,
+                barrier, results):
+    coordinator = ShardCoordinator(lease_path, owner, "pull_request", [],
+                                   shard_count=shard_count, ttl=30, backend=backend)
+    barrier.wait()
+    for _ in range(rounds):
+        coordinator.rebalance()
+        time.sleep(0.05)
+    # nobody changes leases anymore once all replicas are done
+    barrier.wait()
+    results.put((owner, sorted(coordinator.held)))
+
+
+def crash_replica(lease_path: str, backend: str, shard_count: int, ttl: float, results):
+    coordinator = ShardCoordinator(lease_path, "crashed", "pull_request", [],
+                                   shard_count=shard_count, ttl=ttl, backend=backend)
+    coordinator.rebalance()
+    results.put(sorted(coordinator.held))
+    results.close()
+    results.join_thread()
+    # leases are left behind, as by a killed pod
+    os._exit(0)
+
+
+def collect(processes: list, results, count: int):
+    collected = [results.get(timeout=60) for _ in range(count)]
+    for process in processes:
+        process.join(timeout=60)
+        assert process.exitcode == 0
+    return collected
+
+
+@pytest.mark.parametrize("backend", backends)
+def test_lease_is_taken_by_a_single_process(tmp_path, backend):
+    barrier, results = context.Barrier(6), context.Queue()
+    processes = [context.Process(target=race_for_lease,
+                                 args=(str(tmp_path), backend, f"replica-{index}", barrier, results))
+                 for index in range(6)]
+    for process in processes:
+        process.start()
+    acquired = dict(collect(processes, results, len(processes)))
+
+    winners = [owner for owner, success in acquired.items() if success]
+    assert len(winners) == 1
+    assert lease_backends[backend](str(tmp_path)).leases()["shard/0"][0] == winners[0]
+
+
+@pytest.mark.parametrize("backend", backends)
+def test_replicas_split_shards_fairly(tmp_path, backend):
+    replicas, shard_count = 3, 8
+    barrier, results = context.Barrier(replicas), context.Queue()
+    processes = [context.Process(target=run_replica,
+                                 args=(str(tmp_path), backend, f"replica-{index}", shard_count, 20,
+                                       barrier, results))
+                 for index in range(replicas)]
+    for process in processes:
+        process.start()
+    held = dict(collect(processes, results, replicas))
+
+    shards = [shard for owned in held.values() for shard in owned]
+    assert sorted(shards) == sorted(f"shard/{index}" for index in range(shard_count))
+    assert all(len(owned) <= 3 for owned in held.values())
+
+
+@pytest.mark.parametrize("backend", backends)
+def test_shards_of_a_crashed_replica_are_taken_over(tmp_path, backend):
+    shard_count, ttl = 4, 1.5
+    results = context.Queue()
+    process = context.Process(target=crash_replica, args=(str(tmp_path), backend, shard_count, ttl, results))
+    process.start()
+    [crashed] = collect([process], results, 1)
+    assert len(crashed) == shard_count
+
+    coordinator = ShardCoordinator(str(tmp_path), "survivor", "pull_request", [],
+                                   shard_count=shard_count, ttl=ttl, backend=backend)
+    coordinator.rebalance()
+    # the crashed replica's leases are still valid
+    assert len(coordinator.held) < shard_count
+
+    deadline = time.time() + ttl * 4
+    while len(coordinator.held) < shard_count and time.time() < deadline:
+        time.sleep(0.1)
+        coordinator.rebalance()
+    assert len(coordinator.held) == shard_count
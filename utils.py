@@ -1,9 +1,21 @@
-from datetime import datetime, timedelta
-from time import sleep
+from datetime import datetime, timedelta, timezone
+from logging.handlers import QueueHandler, QueueListener
+from time import sleep, monotonic
+from threading import Lock, Event
 from schedule import Scheduler
 from traceback import format_exc
+from typing import NamedTuple
 import configargparse
 import logging
+import random
+import atexit
+import socket
+import queue
+import json
+import os
+
+
+text_log_format = "%(asctime)s - %(threadName)s - %(levelname)s %(message)s"
 
 
 class SafeScheduler(Scheduler):
@@ -34,7 +46,198 @@ class SafeScheduler(Scheduler):
                 self.cancel_job(job)
 
 
-def get_arguments():
+class RateLimiter:
+    """ Thread-safe limiter spacing calls evenly at a given rate per minute """
+
+    def __init__(self, calls_per_minute: int):
+        self.interval = 60.0 / calls_per_minute if calls_per_minute else 0
+        self.next_call = 0.0
+        self.lock = Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            time_now = monotonic()
+            call_time = max(time_now, self.next_call)
+            self.next_call = call_time + self.interval
+        if call_time > time_now:
+            sleep(call_time - time_now)
+
+
+class InFlightCall:
+    """ Result holder of a call shared by concurrent callers """
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class RequestCoalescer:
+    """ Thread-safe single-flight deduplication of calls sharing the same key """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.calls = {}
+        self.saved_calls = 0
+        self.active = True
+
+    def run(self, key: str, func, *args, **kwargs):
+        if not self.active:
+            # lookups between cycles (webhooks, events) are neither shared nor kept
+            return func(*args, **kwargs)
+        with self.lock:
+            call = self.calls.get(key)
+            owner = call is None
+            if owner:
+                call = self.calls[key] = InFlightCall()
+            else:
+                self.saved_calls += 1
+
+        if not owner:
+            logging.debug(f"reusing in-flight or completed call for {key}")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except Exception as err:
+            # failed calls are not reused by later callers
+            call.error = err
+            with self.lock:
+                self.calls.pop(key, None)
+            raise
+        finally:
+            call.done.set()
+
+    def forget(self, key: str):
+        # later callers run the call again instead of reusing a stale result
+        with self.lock:
+            self.calls.pop(key, None)
+
+    def start_cycle(self):
+        with self.lock:
+            self.calls = {}
+            self.active = True
+
+    def reset(self):
+        # ends the cycle, results are not reused afterwards
+        with self.lock:
+            saved_calls = self.saved_calls
+            self.calls = {}
+            self.saved_calls = 0
+            self.active = False
+        return saved_calls
+
+
+class JsonFormatter(logging.Formatter):
+    """ One JSON object per record, fields passed with `extra` (e.g. the cycle summary) are kept """
+
+    record_attributes = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+    def format(self, record: logging.LogRecord):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "thread": record.threadName,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        entry.update({name: value for name, value in vars(record).items()
+                      if name not in self.record_attributes})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level: int, log_format: str = "text"):
+    # threads only enqueue records, a single listener thread formats and writes them
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if log_format == "json" else logging.Formatter(text_log_format))
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    # records are enqueued with their message formatted, the listener adds the rest
+    queue_handler.setFormatter(logging.Formatter("%(message)s"))
+    logging.basicConfig(level=level, handlers=[queue_handler])
+    # debug lines of scheduled jobs print their arguments, API tokens included
+    logging.getLogger("schedule").setLevel(max(level, logging.INFO))
+    listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    # records left in the queue are written on exit
+    atexit.register(listener.stop)
+    return listener
+
+
+class CycleLogSummary:
+    """ Per-cycle counts of per-item events, logged once per cycle instead of a line per item """
+
+    def __init__(self, sample_rate: float = 0.0):
+        self.sample_rate = sample_rate
+        self.counts = {}
+        self.lock = Lock()
+        self.random = random.Random()
+
+    def configure(self, sample_rate: float):
+        self.sample_rate = sample_rate
+
+    def count(self, event: str, amount: int = 1):
+        with self.lock:
+            self.counts[event] = self.counts.get(event, 0) + amount
+
+    def sampled(self):
+        # per-item lines are only logged (and formatted) for a share of the items
+        return self.sample_rate >= 1 or (self.sample_rate > 0 and self.random.random() < self.sample_rate)
+
+    def flush(self):
+        with self.lock:
+            counts, self.counts = self.counts, {}
+        if counts:
+            logging.info("cycle summary: %s", ", ".join(f"{event} {count}" for event, count in sorted(counts.items())),
+                         extra={"summary": counts})
+        return counts
+
+
+log_summary = CycleLogSummary()
+
+
+class SlackChannel(NamedTuple):
+    """ Tracked Slack channel with its own time window and reaction names """
+
+    channel_id: str
+    time_window_minutes: int
+    approved_reaction_name: str
+    merged_reaction_name: str
+    github_error_reaction_name: str
+
+
+def parse_slack_channels(args):
+    # entries are "<channel id>[;<setting>=<value>...]", settings default to the global options
+    channels = {}
+    entries = list(args.slack_channels or [])
+    if args.slack_channel_id and args.slack_channel_id not in [entry.split(";")[0] for entry in entries]:
+        entries.insert(0, args.slack_channel_id)
+    for entry in entries:
+        channel_id, *settings = entry.split(";")
+        channel = SlackChannel(channel_id.strip(),
+                               args.slack_time_window_minutes,
+                               args.slack_approved_reaction_name,
+                               args.slack_merged_reaction_name,
+                               args.slack_github_error_reaction_name)
+        for setting in settings:
+            name, _, value = setting.partition("=")
+            name = name.strip()
+            if name not in SlackChannel._fields[1:]:
+                raise ValueError(f"unknown setting {name} of slack channel {channel_id}")
+            channel = channel._replace(**{name: type(getattr(channel, name))(value.strip())})
+        channels[channel.channel_id] = channel
+    return channels
+
+
+def get_arguments(argv: list = None):
     parser = configargparse.ArgParser(default_config_files=["./config.yaml"])
 
     parser.add_argument("--config_file",
@@ -48,16 +251,60 @@ def get_arguments():
                         type=str,
                         required=True,
                         env_var="SLACK_API_TOKEN")
+    parser.add_argument("--slack_api_url",
+                        action="store",
+                        type=str,
+                        required=False,
+                        env_var="SLACK_API_URL")
     parser.add_argument("--slack_channel_id",
                         action="store",
                         type=str,
-                        required=True,
+                        required=False,
                         env_var="SLACK_CHANNEL_ID")
+    parser.add_argument("--slack_channels",
+                        action="store",
+                        type=str,
+                        nargs="+",
+                        required=False,
+                        env_var="SLACK_CHANNELS")
     parser.add_argument("--slack_time_window_minutes",
                         action="store",
                         type=int,
                         required=True,
                         env_var="SLACK_TIME_WINDOW_MINUTES")
+    parser.add_argument("--slack_incremental_scan",
+                        action="store_true",
+                        required=False,
+                        env_var="SLACK_INCREMENTAL_SCAN")
+    parser.add_argument("--slack_full_scan_cycles",
+                        action="store",
+                        type=int,
+                        required=False,
+                        default=12,
+                        env_var="SLACK_FULL_SCAN_CYCLES")
+    parser.add_argument("--slack_fetch_workers",
+                        action="store",
+                        type=int,
+                        required=False,
+                        default=4,
+                        env_var="SLACK_FETCH_WORKERS")
+    parser.add_argument("--slack_requests_per_minute",
+                        action="store",
+                        type=int,
+                        required=False,
+                        default=50,
+                        env_var="SLACK_REQUESTS_PER_MINUTE")
+    parser.add_argument("--slack_events_port",
+                        action="store",
+                        type=int,
+                        required=False,
+                        default=0,
+                        env_var="SLACK_EVENTS_PORT")
+    parser.add_argument("--slack_signing_secret",
+                        action="store",
+                        type=str,
+                        required=False,
+                        env_var="SLACK_SIGNING_SECRET")
     parser.add_argument("--slack_approved_reaction_name",
                         action="store",
                         type=str,
@@ -81,17 +328,193 @@ def get_arguments():
                         type=str,
                         required=True,
                         env_var="GITHUB_API_TOKEN")
+    parser.add_argument("--github_api_host",
+                        action="store",
+                        type=str,
+                        required=False,
+                        default="https://api.github.com",
+                        env_var="GITHUB_API_HOST")
+    parser.add_argument("--github_backend",
+                        action="store",
+                        type=str,
+                        required=False,
+                        choices=["rest", "graphql"],
+                        default="rest",
+                        env_var="GITHUB_BACKEND")
+    parser.add_argument("--github_graphql_batch_size",
+                        action="store",
+                        type=int,
+                        required=False,
+                        default=50,
+                        env_var="GITHUB_GRAPHQL_BATCH_SIZE")
+    parser.add_argument("--github_rate_limit_reserve_percent",
+                        action="store",
+                        type=int,
+                        required=False,
+                        default=10,
+                        env_var="GITHUB_RATE_LIMIT_RESERVE_PERCENT")
+    parser.add_argument("--github_max_poll_interval_minutes",
+                        action="store",
+                        type=int,
+                        required=False,
+                        default=0,
+                        env_var="GITHUB_MAX_POLL_INTERVAL_MINUTES")
+    parser.add_argument("--github_webhook_port",
+                        action="store",
+                        type=int,
+                        required=False,
+                        default=0,
+                        env_var="GITHUB_WEBHOOK_PORT")
+    parser.add_argument("--github_webhook_secret",
+                        action="store",
+                        type=str,
+                        required=False,
+                        env_var="GITHUB_WEBHOOK_SECRET")
     parser.add_argument("--cache_folder_path",
                         action="store",
                         type=str,
                         required=False,
                         default="./cache",
                         env_var="CACHE_FOLDER_PATH")
+    parser.add_argument("--cache_backend",
+                        action="store",
+                        type=str,
+                        required=False,
+                        choices=["sqlite", "files"],
+                        default="sqlite",
+                        env_var="CACHE_BACKEND")
+    parser.add_argument("--cache_memory_size",
+                        action="store",
+                        type=int,
+                        required=False,
+                        default=1024,
+                        env_var="CACHE_MEMORY_SIZE")
+    parser.add_argument("--cache_flush_interval_seconds",
+                        action="store",
+                        type=int,
+                        required=False,
+                        default=30,
+                        env_var="CACHE_FLUSH_INTERVAL_SECONDS")
+    parser.add_argument("--cache_ttl_hours",
+                        action="store",
+                        type=int,
+                        required=False,
+                        default=168,
+                        env_var="CACHE_TTL_HOURS")
+    parser.add_argument("--cache_max_size_mb",
+                        action="store",
+                        type=int,
+                        required=False,
+                        default=512,
+                        env_var="CACHE_MAX_SIZE_MB")
     parser.add_argument("--sleep_period_minutes",
                         action="store",
                         type=int,
                         required=True,
                         env_var="SLEEP_PERIOD_MINUTES")
+    parser.add_argument("--engine",
+                        action="store",
+                        type=str,
+                        required=False,
+                        choices=["threads", "asyncio"],
+                        default="threads",
+                        env_var="ENGINE")
+    parser.add_argument("--async_concurrency",
+                        action="store",
+                        type=int,
+                        required=False,
+                        default=100,
+                        env_var="ASYNC_CONCURRENCY")
+    parser.add_argument("--review_workers",
+                        action="store",
+                        type=int,
+                        required=False,
+                        default=1,
+                        env_var="REVIEW_WORKERS")
+    parser.add_argument("--details_workers",
+                        action="store",
+                        type=int,
+                        required=False,
+                        default=1,
+                        env_var="DETAILS_WORKERS")
+    parser.add_argument("--shard_by",
+                        action="store",
+                        type=str,
+                        required=False,
+                        choices=["none", "channel", "pull_request"],
+                        default="none",
+                        env_var="SHARD_BY")
+    parser.add_argument("--shard_count",
+                        action="store",
+                        type=int,
+                        required=False,
+                        default=16,
+                        env_var="SHARD_COUNT")
+    parser.add_argument("--lease_backend",
+                        action="store",
+                        type=str,
+                        required=False,
+                        choices=["sqlite", "files"],
+                        default="sqlite",
+                        env_var="LEASE_BACKEND")
+    parser.add_argument("--lease_path",
+                        action="store",
+                        type=str,
+                        required=False,
+                        env_var="LEASE_PATH")
+    parser.add_argument("--lease_ttl_seconds",
+                        action="store",
+                        type=int,
+                        required=False,
+                        default=60,
+                        env_var="LEASE_TTL_SECONDS")
+    parser.add_argument("--replica_id",
+                        action="store",
+                        type=str,
+                        required=False,
+                        env_var="REPLICA_ID")
+    parser.add_argument("--metrics_port",
+                        action="store",
+                        type=int,
+                        required=False,
+                        default=0,
+                        env_var="METRICS_PORT")
+    parser.add_argument("--trace_file",
+                        action="store",
+                        type=str,
+                        required=False,
+                        env_var="TRACE_FILE")
+    parser.add_argument("--profile_cycles",
+                        action="store",
+                        type=int,
+                        required=False,
+                        default=1,
+                        env_var="PROFILE_CYCLES")
+    parser.add_argument("--profile_on_start",
+                        action="store_true",
+                        required=False,
+                        env_var="PROFILE_ON_START")
+    parser.add_argument("--profile_path",
+                        action="store",
+                        type=str,
+                        required=False,
+                        env_var="PROFILE_PATH")
+    parser.add_argument("--record",
+                        action="store",
+                        type=str,
+                        required=False,
+                        env_var="RECORD")
+    parser.add_argument("--replay",
+                        action="store",
+                        type=str,
+                        required=False,
+                        env_var="REPLAY")
+    parser.add_argument("--replay_latency_scale",
+                        action="store",
+                        type=float,
+                        required=False,
+                        default=1.0,
+                        env_var="REPLAY_LATENCY_SCALE")
     parser.add_argument("--max_client_retries",
                         action="store",
                         type=int,
@@ -106,7 +529,49 @@ def get_arguments():
                         action="store_true",
                         required=False,
                         env_var="DEBUG")
-    return parser.parse_args()
+    parser.add_argument("--log_format",
+                        action="store",
+                        choices=["text", "json"],
+                        required=False,
+                        default="text",
+                        env_var="LOG_FORMAT")
+    parser.add_argument("--log_sample_rate",
+                        action="store",
+                        type=float,
+                        required=False,
+                        default=0.01,
+                        env_var="LOG_SAMPLE_RATE")
+    args = parser.parse_args(argv)
+    try:
+        # channel id -> per channel settings
+        args.slack_channels = parse_slack_channels(args)
+    except ValueError as err:
+        parser.error(str(err))
+    if not args.slack_channels:
+        parser.error("one of --slack_channel_id or --slack_channels is required")
+    if args.replica_id is None:
+        args.replica_id = f"{socket.gethostname()}-{os.getpid()}"
+    if args.github_webhook_port and not args.github_webhook_secret:
+        parser.error("--github_webhook_secret is required to receive github webhooks")
+    if args.slack_events_port and not args.slack_signing_secret:
+        parser.error("--slack_signing_secret is required to receive slack events")
+    if args.shard_by != "none" and args.cache_backend == "sqlite":
+        # WAL needs shared memory, which volumes shared by replicas don't provide
+        parser.error("--shard_by requires --cache_backend files, the sqlite cache can't be shared by replicas")
+    if args.record and args.replay:
+        parser.error("--record and --replay are mutually exclusive")
+    if args.engine == "asyncio":
+        # these start receivers or schedules the asyncio engine doesn't have, they'd silently do nothing
+        for option in ("github_webhook_port", "slack_events_port", "github_max_poll_interval_minutes"):
+            if getattr(args, option):
+                parser.error(f"--{option} is not supported by the asyncio engine")
+    return args
+
+
+def exit_on_sigterm(signum, frame):
+    # turn SIGTERM (e.g. pod shutdown) into SystemExit so cleanup code runs
+    logging.warning(f"received signal {signum}, shutting down")
+    raise SystemExit(0)
 
 
 def sleep_until(timestamp: float):